@@ -0,0 +1,93 @@
+"""
+Event loop latency of DBManager vs AsyncDBManager under concurrent client load
+
+Simulates socket server handlers which each run a few queries per event while a probe task
+measures how late the event loop wakes it up. Uses a throwaway sqlite database unless
+RDF_DATABASE_URI is set.
+
+Run from the repository root, with the repository on PYTHONPATH or ravcom installed with
+pip install -e .
+
+    PYTHONPATH=. python benchmarks/event_loop_latency.py --clients 50 --events 20
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ.setdefault("RDF_DATABASE_URI", "sqlite:///{}".format(os.path.join(tempfile.mkdtemp(), "bench.db")))
+
+from ravcom import ravdb, AsyncDBManager  # noqa: E402
+
+PROBE_INTERVAL = 0.001
+
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - PROBE_INTERVAL)
+
+
+async def sync_client(graph_id, events):
+    for _ in range(events):
+        op = ravdb.create_op(graph_id=graph_id, node_type="middle", inputs="[]", params="{}", op_type="unary",
+                             operator="neg")
+        ravdb.get_graph_ops(graph_id)
+        ravdb.update_op(op, status="computed")
+        await asyncio.sleep(0)
+
+
+async def async_client(manager, graph_id, events):
+    for _ in range(events):
+        op = await manager.create_op(graph_id=graph_id, node_type="middle", inputs="[]", params="{}",
+                                     op_type="unary", operator="neg")
+        await manager.get_graph_ops(graph_id)
+        await manager.update_op(op, status="computed")
+
+
+async def run(make_client, clients):
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.ensure_future(probe(lags, stop))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[make_client() for _ in range(clients)])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await probe_task
+    return elapsed, sorted(lags) or [0.0]
+
+
+def report(name, elapsed, lags):
+    def percentile(p):
+        return lags[min(len(lags) - 1, int(p * len(lags)))] * 1000
+
+    print("{:<6} total {:7.2f}s  loop lag p50 {:7.2f}ms  p99 {:7.2f}ms  max {:7.2f}ms".format(
+        name, elapsed, percentile(0.5), percentile(0.99), lags[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--events", type=int, default=20)
+    args = parser.parse_args()
+
+    ravdb.create_tables()
+    graph_id = ravdb.create_graph().id
+    loop = asyncio.get_event_loop()
+
+    elapsed, lags = loop.run_until_complete(run(lambda: sync_client(graph_id, args.events), args.clients))
+    report("sync", elapsed, lags)
+
+    manager = AsyncDBManager()
+    elapsed, lags = loop.run_until_complete(run(lambda: async_client(manager, graph_id, args.events),
+                                                args.clients))
+    report("async", elapsed, lags)
+    manager.close()
+
+
+if __name__ == "__main__":
+    main()
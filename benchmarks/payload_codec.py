@@ -0,0 +1,67 @@
+"""
+Throughput and peak memory of binary payload frames vs the json path for op operands
+
+The json path converts each operand to lists and encodes them as text, as payloads were built
+before ravcom.codec. Both paths round trip a payload with two operands: encode on the server,
+decode back to ndarrays on the client.
+
+Run from the repository root, with the repository on PYTHONPATH or ravcom installed with
+pip install -e .
+
+    PYTHONPATH=. python benchmarks/payload_codec.py --sizes 1000 100000 1000000 --repeat 5
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+
+from ravcom.codec import encode_frame, decode_frame
+
+
+def json_round_trip(meta, tensors):
+    payload = json.dumps({"meta": meta, "values": {name: tensor.tolist() for name, tensor in tensors.items()}})
+    decoded = json.loads(payload)
+    return {name: np.array(value) for name, value in decoded["values"].items()}
+
+
+def frame_round_trip(meta, tensors):
+    _, decoded = decode_frame(encode_frame(meta, tensors))
+    return decoded
+
+
+def measure(round_trip, meta, tensors, repeat):
+    round_trip(meta, tensors)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        round_trip(meta, tensors)
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    round_trip(meta, tensors)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    meta = {"op_id": 1, "operator": "matmul"}
+    for size in args.sizes:
+        tensors = {"lhs": np.random.rand(size), "rhs": np.random.rand(size)}
+        nbytes = sum(tensor.nbytes for tensor in tensors.values())
+
+        for name, round_trip in (("json", json_round_trip), ("frame", frame_round_trip)):
+            elapsed, peak = measure(round_trip, meta, tensors, args.repeat)
+            print("{:<6} {:>9} elements  {:9.1f} MB/s  peak {:9.2f} MB ({:5.1f}x payload)".format(
+                name, size, nbytes / elapsed / 1e6, peak / 1e6, peak / nbytes))
+
+
+if __name__ == "__main__":
+    main()
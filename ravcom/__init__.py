@@ -1,12 +1,22 @@
 import glob
 import os
 
+from .async_db_manager import AsyncDBManager
+from .chunked_store import ChunkedTensor, create_chunked, save_chunked, load_chunked
+from .client_performance import ClientPerformanceModel
+from .codec import encode_frame, encode_frame_parts, encode_stored, decode_frame, is_frame
+from .compiler import GraphCompiler, SuperOp, compile_graph, topological_sort
 from .config import QUEUE_LOW_PRIORITY, QUEUE_HIGH_PRIORITY, QUEUE_COMPUTING, RDF_REDIS_DB, RDF_REDIS_HOST, \
-    RDF_REDIS_PORT, DATA_FILES_PATH
-from .db_manager import OpStatus, GraphStatus, ClientOpMappingStatus, Op, Graph, Data, Client, \
-    ClientOpMapping, DBManager
-from .redis_manager import RavQueue, clear_redis_queues
-from .utils import dump_data, delete_data_file, save_data_to_file, inform_server, Singleton, copy_data
+    RDF_REDIS_PORT, DATA_FILES_PATH, QUEUE_READY
+from .db_manager import OpStatus, GraphStatus, ClientOpMappingStatus, DataStatus, Op, Graph, Data, Client, \
+    ClientOpMapping, OpDependency, DBManager
+from .readiness import GraphReadiness
+from .redis_manager import RavQueue, PriorityRavQueue, QueueReaper, clear_redis_queues
+from .scheduler import CriticalPathScheduler, critical_path_lengths, compute_op_priorities
+from .storage import StorageBackend, LocalStorage, RedisStorage, S3Storage, get_storage
+from .tensor_store import save_tensor, load_tensor, delete_tensor, hash_tensor, tensor_exists
+from .utils import dump_data, delete_data_file, save_data_to_file, load_data_from_file, inform_server, Singleton, \
+    copy_data
 
 ravdb = DBManager.Instance()
 
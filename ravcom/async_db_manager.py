@@ -0,0 +1,58 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from .db_manager import Base, DBManager
+
+
+class AsyncDBManager(object):
+    """
+    Asyncio front end to DBManager for the socket server
+
+    Exposes the same methods as DBManager as coroutines. SQLAlchemy 1.3 has no asyncio support,
+    so each call runs on a thread pool sized like the connection pool, using that thread's scoped
+    session of the shared DBManager, and the event loop only awaits the result. The worker sessions
+    don't expire objects on commit and are removed after every call, so returned objects can be
+    read from the event loop. Objects passed in are loaded again in the worker's session, so only the
+    changes a call makes are written, never stale attributes of the caller's copy.
+    """
+
+    def __init__(self, max_workers=None):
+        # The same manager as ravdb, so the identity cache, client index and writer stay shared
+        self.db = DBManager.Instance()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or config.RDF_DB_POOL_SIZE,
+                                           thread_name_prefix="ravdb")
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        method = getattr(self.db, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def call(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(self._call, method, args, kwargs))
+
+        return call
+
+    def _call(self, method, args, kwargs):
+        session = self.db.session
+        session().expire_on_commit = False
+        try:
+            args = [self._load(session, arg) for arg in args]
+            kwargs = {key: self._load(session, value) for key, value in kwargs.items()}
+            return method(*args, **kwargs)
+        finally:
+            session.remove()
+
+    def _load(self, session, value):
+        if not isinstance(value, Base) or value.id is None:
+            return value
+        return session.query(type(value)).get(value.id)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
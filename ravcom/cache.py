@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Sets the value only while the version of its key is still the one read by reserve()
+SET_IF_VERSION_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[2] then
+    return 0
+end
+if ARGV[3] ~= '' then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+else
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+
+class LRUCache(object):
+    """
+    Thread-safe in-process LRU cache with an optional time to live in seconds
+
+    Fills after a miss call reserve() before reading the value and pass its token to set(), which
+    then skips the value if the key was deleted in between, as it may be stale.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._reservations = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and (item[1] is None or item[1] > time.time()):
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+
+            if item is not None:
+                del self._items[key]
+                self.evictions += 1
+            self.misses += 1
+            return None
+
+    def reserve(self, key):
+        token = object()
+        with self._lock:
+            self._reservations[key] = token
+        return token
+
+    def set(self, key, value, token=None):
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if token is not None:
+                if self._reservations.get(key) is not token:
+                    return
+                del self._reservations[key]
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._items.pop(key, None)
+                self._reservations.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._reservations.clear()
+
+    def get_stats(self):
+        return {"backend": "memory", "size": len(self._items), "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+
+class RedisCache(object):
+    """
+    Cache shared by every process through redis, values are json strings and expire after ttl seconds
+
+    Eviction beyond the ttl is left to the redis maxmemory policy. Deletes bump a version key next
+    to each value, reserve() reads it and set() with its token only writes while it is unchanged.
+    """
+
+    def __init__(self, client, ttl=None, prefix="cache:"):
+        self.r = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self._set_if_version = self.r.register_script(SET_IF_VERSION_SCRIPT)
+
+        self.hits = 0
+        self.misses = 0
+
+    def _version_key(self, key):
+        return "{}version:{}".format(self.prefix, key)
+
+    def get(self, key):
+        value = self.r.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def reserve(self, key):
+        return self.r.get(self._version_key(key)) or b""
+
+    def set(self, key, value, token=None):
+        if token is None:
+            self.r.set(self.prefix + key, value, ex=int(self.ttl) if self.ttl else None)
+            return
+        self._set_if_version(keys=[self.prefix + key, self._version_key(key)],
+                             args=[value, token, int(self.ttl) if self.ttl else ""])
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        pipe.delete(*[self.prefix + key for key in keys])
+        for key in keys:
+            # Outlives any fill that read the old version, values expire after ttl anyway
+            pipe.incr(self._version_key(key))
+            pipe.expire(self._version_key(key), int(self.ttl) if self.ttl else 3600)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self.r.scan_iter(match=self.prefix + "*", count=1000))
+        for start in range(0, len(keys), 1000):
+            self.r.delete(*keys[start:start + 1000])
+
+    def get_stats(self):
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses}
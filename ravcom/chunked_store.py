@@ -0,0 +1,242 @@
+import itertools
+import json
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+from .config import RDF_CHUNK_BYTES
+from .storage import get_location, get_storage
+
+CHUNKED_EXTENSION = ".chunked"
+CHUNKED_MAGIC = b"RAVCHUNK"
+
+
+def get_chunked_path(data_id):
+    """
+    Get the location of the file a chunked tensor is stored in
+    """
+    return get_location("data_{}{}".format(data_id, CHUNKED_EXTENSION))
+
+
+def default_chunk_shape(shape, dtype):
+    """
+    Split along the first axis into tiles of roughly RDF_CHUNK_BYTES
+    """
+    if len(shape) == 0:
+        return ()
+    row_bytes = int(np.prod(shape[1:], dtype=np.int64)) * np.dtype(dtype).itemsize
+    rows = max(1, RDF_CHUNK_BYTES // max(row_bytes, 1))
+    return (min(rows, max(shape[0], 1)),) + tuple(shape[1:])
+
+
+def create_chunked(file_path, shape, dtype, chunk_shape=None):
+    """
+    Allocate an empty chunked tensor which is then filled with ChunkedTensor.write()
+
+    chunk_shape holds the tile size along every axis, None keeps an axis whole. The file is a
+    magic string, a length prefixed json index header with the offset of every tile, then the
+    tiles in C order, each tile contiguous.
+    """
+    shape = tuple(int(size) for size in shape)
+    dtype = np.dtype(dtype)
+    if chunk_shape is None:
+        chunk_shape = default_chunk_shape(shape, dtype)
+    chunk_shape = tuple(max(1, int(size if size is not None else dim)) for size, dim in zip(chunk_shape, shape))
+    if len(chunk_shape) != len(shape):
+        raise ValueError("Chunk shape {} doesn't match shape {}".format(chunk_shape, shape))
+
+    grid = [range(0, dim, size) for dim, size in zip(shape, chunk_shape)]
+    offsets = []
+    offset = 0
+    for starts in itertools.product(*grid):
+        offsets.append(offset)
+        tile_size = int(np.prod([min(size, dim - start) for start, size, dim in zip(starts, chunk_shape, shape)]))
+        offset += tile_size * dtype.itemsize
+
+    header = json.dumps({"dtype": dtype.str, "shape": shape, "chunk_shape": chunk_shape,
+                         "offsets": offsets}).encode("utf-8")
+    data_offset = len(CHUNKED_MAGIC) + 4 + len(header)
+
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as f:
+        f.write(CHUNKED_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        f.truncate(data_offset + offset)
+
+    return ChunkedTensor(file_path, mode="r+")
+
+
+def save_chunked(data_id, data, chunk_shape=None):
+    """
+    Write an ndarray as a chunked tensor, returns the file location
+
+    The tiles are written to a local temporary file which is then moved to the storage backend.
+    """
+    array = np.asarray(data)
+    file_path = get_chunked_path(data_id)
+    storage = get_storage(file_path)
+    local_path = storage.local_path(file_path)
+    if local_path is not None:
+        tmp_path = "{}.tmp".format(local_path)
+    else:
+        fd, tmp_path = tempfile.mkstemp(suffix=CHUNKED_EXTENSION)
+        os.close(fd)
+
+    tensor = create_chunked(tmp_path, array.shape, array.dtype, chunk_shape=chunk_shape)
+    for index, _ in tensor.iter_tiles():
+        tensor.write(index, array[index])
+    tensor.close()
+
+    return storage.put_file(file_path, tmp_path)
+
+
+class ChunkedTensor(object):
+    """
+    Memory-mapped view of a chunked tensor
+
+    read() and write() take an index of ints and step-less slices and only touch the tiles it
+    overlaps, so a worker can read one row block of a large matrix without loading the rest.
+    """
+
+    def __init__(self, file_path, mode="r"):
+        self.file_path = file_path
+
+        with open(file_path, "rb") as f:
+            if f.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+                raise ValueError("{} is not a chunked tensor".format(file_path))
+            header_length, = struct.unpack("<I", f.read(4))
+            header = json.loads(f.read(header_length).decode("utf-8"))
+
+        self.dtype = np.dtype(header["dtype"])
+        self.shape = tuple(header["shape"])
+        self.chunk_shape = tuple(header["chunk_shape"])
+        self.offsets = header["offsets"]
+        self.grid_shape = tuple(-(-dim // size) for dim, size in zip(self.shape, self.chunk_shape))
+
+        data_offset = len(CHUNKED_MAGIC) + 4 + header_length
+        size = os.path.getsize(file_path) - data_offset
+        self._buffer = np.memmap(file_path, dtype=np.uint8, mode=mode, offset=data_offset, shape=(size,)) \
+            if size > 0 else np.zeros(0, dtype=np.uint8)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def tile(self, grid_index):
+        """
+        Get the tile at a position of the tile grid as an ndarray backed by the file
+        """
+        starts = [position * size for position, size in zip(grid_index, self.chunk_shape)]
+        tile_shape = tuple(min(size, dim - start) for start, size, dim in zip(starts, self.chunk_shape, self.shape))
+        flat_index = int(np.ravel_multi_index(grid_index, self.grid_shape)) if self.ndim else 0
+        offset = self.offsets[flat_index]
+        nbytes = int(np.prod(tile_shape, dtype=np.int64)) * self.dtype.itemsize
+        return self._buffer[offset:offset + nbytes].view(self.dtype).reshape(tile_shape)
+
+    def _normalize(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        if len(index) > self.ndim:
+            raise IndexError("Too many indices for a tensor of {} dimensions".format(self.ndim))
+
+        bounds = []
+        squeeze = []
+        for axis, dim in enumerate(self.shape):
+            key = index[axis] if axis < len(index) else slice(None)
+            if isinstance(key, slice):
+                start, stop, step = key.indices(dim)
+                if step != 1:
+                    raise IndexError("Chunked tensors only support slices without a step")
+                bounds.append((start, max(start, stop)))
+            elif isinstance(key, (int, np.integer)):
+                key = int(key) + dim if key < 0 else int(key)
+                if not 0 <= key < dim:
+                    raise IndexError("Index {} is out of bounds for axis {} with size {}".format(key, axis, dim))
+                bounds.append((key, key + 1))
+                squeeze.append(axis)
+            else:
+                raise IndexError("Chunked tensors only support integers and slices")
+        return bounds, tuple(squeeze)
+
+    def _overlapping_tiles(self, bounds):
+        ranges = [range(start // size, -(-stop // size)) for (start, stop), size in zip(bounds, self.chunk_shape)]
+        for grid_index in itertools.product(*ranges):
+            tile_slices = []
+            out_slices = []
+            for (start, stop), position, size in zip(bounds, grid_index, self.chunk_shape):
+                tile_start = position * size
+                low, high = max(start, tile_start), min(stop, tile_start + size)
+                tile_slices.append(slice(low - tile_start, high - tile_start))
+                out_slices.append(slice(low - start, high - start))
+            yield grid_index, tuple(tile_slices), tuple(out_slices)
+
+    def read(self, index=()):
+        """
+        Read a block into memory
+        """
+        bounds, squeeze = self._normalize(index)
+        out = np.empty([stop - start for start, stop in bounds], dtype=self.dtype)
+        for grid_index, tile_slices, out_slices in self._overlapping_tiles(bounds):
+            out[out_slices] = self.tile(grid_index)[tile_slices]
+        return out.squeeze(axis=squeeze) if squeeze else out
+
+    def write(self, index, values):
+        """
+        Write a block, the tensor must be opened with mode r+
+        """
+        bounds, squeeze = self._normalize(index)
+        values = np.asarray(values, dtype=self.dtype)
+        if squeeze and 0 < values.ndim == len(bounds) - len(squeeze):
+            values = np.expand_dims(values, axis=squeeze)
+        values = np.broadcast_to(values, [stop - start for start, stop in bounds])
+        for grid_index, tile_slices, out_slices in self._overlapping_tiles(bounds):
+            self.tile(grid_index)[tile_slices] = values[out_slices]
+
+    def iter_tiles(self):
+        """
+        Yield the index of every tile, as a tuple of slices, and the tile itself
+        """
+        for grid_index in itertools.product(*[range(size) for size in self.grid_shape]):
+            index = tuple(slice(position * size, min((position + 1) * size, dim))
+                          for position, size, dim in zip(grid_index, self.chunk_shape, self.shape))
+            yield index, self.tile(grid_index)
+
+    def iter_chunks(self, axis=0, rows=None):
+        """
+        Stream the tensor as in-memory blocks of rows along an axis, a tile's worth by default
+        """
+        rows = rows or self.chunk_shape[axis]
+        for start in range(0, self.shape[axis], rows):
+            index = (slice(None),) * axis + (slice(start, min(start + rows, self.shape[axis])),)
+            yield index, self.read(index)
+
+    def __getitem__(self, index):
+        return self.read(index)
+
+    def __setitem__(self, index, values):
+        self.write(index, values)
+
+    def __array__(self, dtype=None):
+        array = self.read()
+        return array.astype(dtype) if dtype is not None else array
+
+    def flush(self):
+        if isinstance(self._buffer, np.memmap):
+            self._buffer.flush()
+
+    def close(self):
+        self.flush()
+        self._buffer = None
+
+
+def load_chunked(file_path, mode="r"):
+    """
+    Open a chunked tensor
+    """
+    return ChunkedTensor(file_path, mode=mode)
@@ -0,0 +1,62 @@
+import threading
+from collections import defaultdict
+
+# Mapping statuses which mean a client is still working on an op
+BUSY_MAPPING_STATUSES = ("sent", "acknowledged", "computing")
+
+
+class ClientAvailabilityIndex(object):
+    """
+    In-memory index of connected clients and the number of ops each one is busy with
+
+    Kept current by DBManager on client status and mapping status changes, so idle clients are
+    known without a query. Only consistent when one process writes clients and mappings.
+    """
+
+    def __init__(self):
+        self.connected = set()
+        self.idle = set()
+        self.busy = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def load(self, connected_ids, busy_counts):
+        with self._lock:
+            self.connected = set(connected_ids)
+            self.busy = defaultdict(int, busy_counts)
+            self.idle = {client_id for client_id in self.connected if self.busy[client_id] == 0}
+
+    def _refresh(self, client_id):
+        if client_id in self.connected and self.busy[client_id] == 0:
+            self.idle.add(client_id)
+        else:
+            self.idle.discard(client_id)
+
+    def set_status(self, client_id, status):
+        """
+        Record a client status change
+        """
+        with self._lock:
+            if status == "connected":
+                self.connected.add(client_id)
+            else:
+                self.connected.discard(client_id)
+            self._refresh(client_id)
+
+    def update_mapping(self, old_client_id, old_status, client_id, status):
+        """
+        Record a mapping change, old values are None for new mappings
+        """
+        with self._lock:
+            if old_client_id is not None and old_status in BUSY_MAPPING_STATUSES:
+                self.busy[old_client_id] = max(self.busy[old_client_id] - 1, 0)
+                self._refresh(old_client_id)
+            if client_id is not None and status in BUSY_MAPPING_STATUSES:
+                self.busy[client_id] += 1
+                self._refresh(client_id)
+
+    def get_idle(self):
+        """
+        Get the ids of connected clients without busy mappings
+        """
+        with self._lock:
+            return set(self.idle)
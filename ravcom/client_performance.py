@@ -0,0 +1,137 @@
+import random
+import threading
+from collections import defaultdict
+
+# Latency assumed for ops nothing is known about yet, in seconds
+DEFAULT_LATENCY = 1.0
+
+
+class Ewma(object):
+    """
+    Exponentially weighted moving average
+    """
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+        self.count = 0
+
+    def update(self, value):
+        self.value = value if self.value is None else self.alpha * value + (1 - self.alpha) * self.value
+        self.count += 1
+        return self.value
+
+
+class ClientPerformanceModel(object):
+    """
+    Latency and failure rate of every client, learned from finished client op mappings
+
+    Keeps a latency EWMA per client, per client and operator and per operator for the whole fleet,
+    an EWMA of failures per client and a reservoir sample of latencies per operator. Updated
+    incrementally by DBManager as mappings finish.
+    """
+
+    def __init__(self, alpha=0.2, reservoir_size=256, failure_penalty=4.0):
+        self.alpha = alpha
+        self.reservoir_size = reservoir_size
+        self.failure_penalty = failure_penalty
+
+        self.client_latency = defaultdict(self._ewma)
+        self.operator_latency = defaultdict(self._ewma)
+        self.fleet_latency = defaultdict(self._ewma)
+        self.failure_rate = defaultdict(self._ewma)
+
+        self.samples = defaultdict(list)
+        self._sample_counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def _ewma(self):
+        return Ewma(self.alpha)
+
+    def record(self, client_id, operator, latency=None, failed=False):
+        """
+        Record a finished mapping, latency in seconds is only used for successful ones
+        """
+        with self._lock:
+            self.failure_rate[client_id].update(1.0 if failed else 0.0)
+            if failed or latency is None:
+                return
+
+            self.client_latency[client_id].update(latency)
+            self.operator_latency[(client_id, operator)].update(latency)
+            self.fleet_latency[operator].update(latency)
+            self._sample(operator, latency)
+
+    def _sample(self, operator, latency):
+        # Reservoir sampling keeps a uniform sample of every latency seen for the operator
+        self._sample_counts[operator] += 1
+        samples = self.samples[operator]
+        if len(samples) < self.reservoir_size:
+            samples.append(latency)
+        else:
+            index = random.randrange(self._sample_counts[operator])
+            if index < self.reservoir_size:
+                samples[index] = latency
+
+    def get_latency(self, client_id, operator=None):
+        """
+        Get the expected latency of a client, for an operator when it ran one before
+
+        Falls back to the client's latency over all operators, then to the fleet's latency for the
+        operator, so new clients are neither favoured nor avoided.
+        """
+        with self._lock:
+            for ewma in (self.operator_latency.get((client_id, operator)), self.client_latency.get(client_id),
+                         self.fleet_latency.get(operator)):
+                if ewma is not None and ewma.value is not None:
+                    return ewma.value
+        return DEFAULT_LATENCY
+
+    def get_failure_rate(self, client_id):
+        with self._lock:
+            ewma = self.failure_rate.get(client_id)
+            return ewma.value if ewma is not None and ewma.value is not None else 0.0
+
+    def get_latency_quantile(self, operator, quantile):
+        """
+        Get a quantile of the sampled latencies of an operator, None without samples
+        """
+        with self._lock:
+            samples = sorted(self.samples.get(operator, []))
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(quantile * len(samples)))]
+
+    def get_sample_count(self, operator):
+        with self._lock:
+            return len(self.samples.get(operator, []))
+
+    def score(self, client_id, operator=None):
+        """
+        Expected cost of running an op on a client, lower is better
+
+        The expected latency is inflated by the failure rate, as failed ops have to run again.
+        """
+        return self.get_latency(client_id, operator) * (1 + self.failure_penalty * self.get_failure_rate(client_id))
+
+    def rank(self, client_ids, operator=None):
+        """
+        Sort clients from best to worst for an operator
+        """
+        return sorted(client_ids, key=lambda client_id: (self.score(client_id, operator), client_id))
+
+    def select(self, client_ids, operator=None, large=False, fast_fraction=0.25):
+        """
+        Pick a client for an op
+
+        Large ops get the best client. Small ops get the best client outside of the fastest
+        fast_fraction of the candidates, which are kept free for large ops, unless no other is left.
+        """
+        ranked = self.rank(client_ids, operator)
+        if not ranked:
+            return None
+        if large:
+            return ranked[0]
+
+        reserved = int(len(ranked) * fast_fraction)
+        return ranked[reserved] if reserved < len(ranked) else ranked[0]
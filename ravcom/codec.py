@@ -0,0 +1,99 @@
+import json
+import struct
+
+import numpy as np
+
+from .tensor_store import load_tensor, to_ndarray
+
+FRAME_MAGIC = b"RAVF"
+FRAME_VERSION = 1
+
+# Tensor buffers start at multiples of this many bytes so decoded arrays are aligned
+FRAME_ALIGNMENT = 64
+
+_PREFIX = struct.Struct("<4sBI")
+
+
+def _padding(size):
+    return -size % FRAME_ALIGNMENT
+
+
+def encode_frame_parts(meta, tensors):
+    """
+    Encode a payload as a list of buffers which concatenated form one binary frame
+
+    meta is any json serializable dict, tensors maps names to arrays. The frame is a magic string,
+    a version, a length prefixed json header describing every tensor, then the raw tensor buffers,
+    each aligned to FRAME_ALIGNMENT bytes. The buffers are memoryviews of the arrays themselves,
+    so memory-mapped tensors are sent without being copied or converted to lists.
+    """
+    arrays = [(name, to_ndarray(tensor)) for name, tensor in tensors.items()]
+
+    descriptions = []
+    offset = 0
+    for name, array in arrays:
+        descriptions.append({"name": name, "dtype": array.dtype.str, "shape": array.shape,
+                             "offset": offset, "nbytes": array.nbytes})
+        offset += array.nbytes + _padding(array.nbytes)
+
+    header = json.dumps({"meta": meta, "tensors": descriptions}).encode("utf-8")
+    header_size = _PREFIX.size + len(header)
+    parts = [_PREFIX.pack(FRAME_MAGIC, FRAME_VERSION, len(header)), header, b"\0" * _padding(header_size)]
+
+    for _, array in arrays:
+        parts.append(memoryview(array.reshape(-1).view(np.uint8)))
+        parts.append(b"\0" * _padding(array.nbytes))
+    return parts
+
+
+def encode_frame(meta, tensors):
+    """
+    Encode a payload as one bytes frame, e.g. a socket.io binary attachment
+
+    This copies every tensor once into the frame, use encode_frame_parts() to write the buffers
+    out directly.
+    """
+    return b"".join(encode_frame_parts(meta, tensors))
+
+
+def encode_stored(meta, file_paths):
+    """
+    Encode a payload straight from stored tensors, file_paths maps names to data file locations
+    """
+    return encode_frame(meta, {name: load_tensor(file_path) for name, file_path in file_paths.items()})
+
+
+def decode_frame(frame):
+    """
+    Decode a frame into its meta dict and a dict of arrays
+
+    The arrays are views of the frame, not copies, and are read-only unless the frame is a
+    writable buffer such as a bytearray.
+    """
+    frame = memoryview(frame)
+    magic, version, header_length = _PREFIX.unpack_from(frame)
+    if magic != FRAME_MAGIC:
+        raise ValueError("Not a payload frame")
+    if version != FRAME_VERSION:
+        raise ValueError("Unsupported payload frame version {}".format(version))
+
+    header_end = _PREFIX.size + header_length
+    header = json.loads(bytes(frame[_PREFIX.size:header_end]).decode("utf-8"))
+    data_start = header_end + _padding(header_end)
+
+    tensors = {}
+    for description in header["tensors"]:
+        start = data_start + description["offset"]
+        buffer = frame[start:start + description["nbytes"]]
+        if len(buffer) != description["nbytes"]:
+            raise ValueError("Payload frame is truncated")
+        tensors[description["name"]] = np.frombuffer(buffer, dtype=np.dtype(description["dtype"])) \
+            .reshape(description["shape"])
+    return header["meta"], tensors
+
+
+def is_frame(payload):
+    """
+    Check whether a payload is a binary frame rather than a json payload
+    """
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:len(FRAME_MAGIC)]) == FRAME_MAGIC
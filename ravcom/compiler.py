@@ -0,0 +1,220 @@
+import heapq
+import json
+from collections import defaultdict
+
+from . import config
+from .readiness import get_parent_op_ids
+
+# Operators which map every element independently, so a chain of them can run as one pass
+ELEMENTWISE_OPERATORS = frozenset([
+    "neg", "abs", "exp", "natlog", "square", "square_root", "sqrt", "cube_root", "pos", "sign",
+    "add", "sub", "mul", "div", "pow", "mod", "greater", "greater_equal", "less", "less_equal",
+    "equal", "not_equal", "logical_and", "logical_or", "logical_not", "logical_xor", "sigmoid", "tanh",
+    "relu", "linear"
+])
+
+
+def topological_sort(parents):
+    """
+    Order op ids so every op comes after its parents, ties broken by op id
+
+    parents maps op ids to parent op ids, parents outside of its keys are ignored. Raises a
+    ValueError if the ops have a cycle.
+    """
+    children = defaultdict(list)
+    remaining = {}
+    for op_id, parent_ids in parents.items():
+        remaining[op_id] = 0
+    for op_id, parent_ids in parents.items():
+        for parent_id in parent_ids:
+            if parent_id in parents:
+                children[parent_id].append(op_id)
+                remaining[op_id] += 1
+
+    heap = [op_id for op_id, count in remaining.items() if count == 0]
+    heapq.heapify(heap)
+    order = []
+    while heap:
+        op_id = heapq.heappop(heap)
+        order.append(op_id)
+        for child_id in children[op_id]:
+            remaining[child_id] -= 1
+            if remaining[child_id] == 0:
+                heapq.heappush(heap, child_id)
+
+    if len(order) != len(parents):
+        raise ValueError("Ops {} form a cycle".format(sorted(set(parents) - set(order))))
+    return order
+
+
+class SuperOp(object):
+    """
+    One or more ops of a graph which a client executes in a single assignment
+
+    kind is single, fused (a chain of elementwise ops, each feeding the next) or batched
+    (independent ops with the same operator and params). ops are in execution order.
+    """
+
+    SINGLE = "single"
+    FUSED = "fused"
+    BATCHED = "batched"
+
+    def __init__(self, kind, ops):
+        self.kind = kind
+        self.ops = ops
+        self.op_ids = [op.id for op in ops]
+
+        own = set(self.op_ids)
+        self.parent_op_ids = []
+        for op in ops:
+            for parent_id in get_parent_op_ids(op.inputs, op.params):
+                if parent_id not in own and parent_id not in self.parent_op_ids:
+                    self.parent_op_ids.append(parent_id)
+
+    def to_payload(self):
+        """
+        Get the assignment sent to a client
+
+        Inputs refer to op ids. The client needs the results of parent_op_ids, inputs referring to an
+        op of the same super-op are the results it computed itself earlier in the list.
+        """
+        return {
+            "kind": self.kind,
+            "op_ids": self.op_ids,
+            "parent_op_ids": self.parent_op_ids,
+            "ops": [{"op_id": op.id, "op_type": op.op_type, "operator": op.operator,
+                     "inputs": json.loads(op.inputs) if op.inputs else [],
+                     "params": json.loads(op.params) if op.params else {}} for op in self.ops]
+        }
+
+    def scatter(self, db, results, data_type="ndarray"):
+        """
+        Store a client's results, a dict of op id to value or a list in op order, as the outputs of
+        the original ops and mark them computed
+        """
+        if not isinstance(results, dict):
+            results = dict(zip(self.op_ids, results))
+
+        missing = [op_id for op_id in self.op_ids if op_id not in results]
+        if missing:
+            raise ValueError("Missing results of ops {}".format(missing))
+
+        for op in self.ops:
+            data = db.create_data_complete(results[op.id], data_type)
+            db.update_op(op, outputs=json.dumps([data.id]), status="computed")
+        return self.ops
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __repr__(self):
+        return "SuperOp({}, {})".format(self.kind, self.op_ids)
+
+
+class GraphCompiler(object):
+    """
+    Groups the pending ops of a graph into super-ops to cut per-op dispatch round trips
+
+    Chains of elementwise ops, where each op's only consumer is the next one, are fused. Remaining
+    ops at the same depth of the graph with the same operator and params are batched. Both rules
+    keep the super-ops acyclic: anything depending on a fused op goes through the chain's last op,
+    and dependencies always point to a greater depth.
+    """
+
+    def __init__(self, ops, max_fused=None, max_batch=None):
+        self.ops = {op.id: op for op in ops if op.status == "pending"}
+        self.max_fused = max_fused or config.RDF_COMPILER_MAX_FUSED
+        self.max_batch = max_batch or config.RDF_COMPILER_MAX_BATCH
+
+        self.parents = {op_id: [parent_id for parent_id in get_parent_op_ids(op.inputs, op.params)
+                                if parent_id in self.ops] for op_id, op in self.ops.items()}
+        self.children = defaultdict(list)
+        for op_id, parent_ids in self.parents.items():
+            for parent_id in set(parent_ids):
+                self.children[parent_id].append(op_id)
+
+        self.order = topological_sort(self.parents)
+
+    def get_depths(self):
+        depths = {}
+        for op_id in self.order:
+            depths[op_id] = 1 + max([depths[parent_id] for parent_id in self.parents[op_id]] or [-1])
+        return depths
+
+    def _is_fusable(self, op_id):
+        return self.ops[op_id].operator in ELEMENTWISE_OPERATORS
+
+    def find_chains(self):
+        """
+        Get the fusable chains of two or more ops, as lists of op ids in execution order
+        """
+        chains = []
+        assigned = set()
+        for op_id in self.order:
+            if op_id in assigned or not self._is_fusable(op_id):
+                continue
+
+            chain = [op_id]
+            while len(chain) < self.max_fused:
+                children = self.children[chain[-1]]
+                if len(children) != 1 or children[0] in assigned or not self._is_fusable(children[0]):
+                    break
+                chain.append(children[0])
+
+            if len(chain) > 1:
+                chains.append(chain)
+                assigned.update(chain)
+        return chains
+
+    def find_batches(self, exclude=()):
+        """
+        Get groups of two or more ops at the same depth with the same operator and params
+        """
+        depths = self.get_depths()
+        groups = defaultdict(list)
+        for op_id in self.order:
+            if op_id in exclude:
+                continue
+            op = self.ops[op_id]
+            groups[(depths[op_id], op.op_type, op.operator, op.params)].append(op_id)
+
+        batches = []
+        for op_ids in groups.values():
+            for start in range(0, len(op_ids), self.max_batch):
+                batch = op_ids[start:start + self.max_batch]
+                if len(batch) > 1:
+                    batches.append(batch)
+        return batches
+
+    def compile(self):
+        """
+        Get the super-ops covering every pending op, in an order which respects their dependencies
+        """
+        groups = {}
+        for chain in self.find_chains():
+            for op_id in chain:
+                groups[op_id] = (SuperOp.FUSED, chain)
+        for batch in self.find_batches(exclude=set(groups)):
+            for op_id in batch:
+                groups[op_id] = (SuperOp.BATCHED, batch)
+
+        # Order the super-ops themselves, named after their first op
+        group_ops = {}
+        for op_id in self.order:
+            kind, op_ids = groups.get(op_id, (SuperOp.SINGLE, [op_id]))
+            group_ops.setdefault(op_ids[0], (kind, op_ids))
+
+        group_parents = {group_id: [groups.get(parent_id, (None, [parent_id]))[1][0]
+                                    for op_id in op_ids for parent_id in self.parents[op_id]
+                                    if parent_id not in op_ids]
+                         for group_id, (kind, op_ids) in group_ops.items()}
+
+        return [SuperOp(group_ops[group_id][0], [self.ops[op_id] for op_id in group_ops[group_id][1]])
+                for group_id in topological_sort(group_parents)]
+
+
+def compile_graph(db, graph_id, max_fused=None, max_batch=None):
+    """
+    Compile the pending ops of a graph into super-ops
+    """
+    return GraphCompiler(db.get_graph_ops(graph_id), max_fused=max_fused, max_batch=max_batch).compile()
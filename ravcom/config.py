@@ -15,8 +15,111 @@ RDF_REDIS_DB = os.environ.get("RDF_REDIS_DB", "0")
 QUEUE_HIGH_PRIORITY = "queue:high_priority"
 QUEUE_LOW_PRIORITY = "queue:low_priority"
 QUEUE_COMPUTING = "queue:computing"
+QUEUE_READY = "queue:ready"
+
+# Seconds a reliably popped value stays in flight before it's requeued, and how often to check
+RDF_QUEUE_VISIBILITY_TIMEOUT = float(os.environ.get("RDF_QUEUE_VISIBILITY_TIMEOUT", "60"))
+RDF_QUEUE_REAPER_INTERVAL = float(os.environ.get("RDF_QUEUE_REAPER_INTERVAL", "1"))
 
 RAVSOCK_SERVER_URL = os.environ.get("RAVSOCK_SERVER_URL", "http://0.0.0.0:9999")
 
 RDF_DATABASE_URI = os.environ.get("RDF_DATABASE_URI", "sqlite:///{}/rdf.db".format(BASE_DIR))
-RDF_REDIS_URI = os.environ.get("RDF_REDIS_URI", "redis://localhost:6379?db=0")
+RDF_REDIS_URI = os.environ.get("RDF_REDIS_URI", "redis://{}:{}/{}".format(RDF_REDIS_HOST, RDF_REDIS_PORT,
+                                                                          RDF_REDIS_DB))
+
+# Redis connection pool, a unix socket path takes precedence over RDF_REDIS_URI
+RDF_REDIS_UNIX_SOCKET = os.environ.get("RDF_REDIS_UNIX_SOCKET", None)
+RDF_REDIS_MAX_CONNECTIONS = int(os.environ.get("RDF_REDIS_MAX_CONNECTIONS", "50"))
+RDF_REDIS_SOCKET_TIMEOUT = float(os.environ["RDF_REDIS_SOCKET_TIMEOUT"]) \
+    if os.environ.get("RDF_REDIS_SOCKET_TIMEOUT") else None
+RDF_REDIS_SOCKET_CONNECT_TIMEOUT = float(os.environ.get("RDF_REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+RDF_REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get("RDF_REDIS_HEALTH_CHECK_INTERVAL", "30"))
+
+# Database connection pool, sqlite only uses the recycle time
+RDF_DB_POOL_SIZE = int(os.environ.get("RDF_DB_POOL_SIZE", "10"))
+RDF_DB_MAX_OVERFLOW = int(os.environ.get("RDF_DB_MAX_OVERFLOW", "20"))
+RDF_DB_POOL_RECYCLE = int(os.environ.get("RDF_DB_POOL_RECYCLE", "3600"))
+RDF_DB_POOL_TIMEOUT = int(os.environ.get("RDF_DB_POOL_TIMEOUT", "30"))
+
+# One database session per thread or per asyncio task
+RDF_DB_SESSION_SCOPE = os.environ.get("RDF_DB_SESSION_SCOPE", "thread")
+
+# An op stops being redispatched once this many of its mappings are in a status
+RDF_MAX_SENT_MAPPINGS = int(os.environ.get("RDF_MAX_SENT_MAPPINGS", "3"))
+RDF_MAX_COMPUTING_MAPPINGS = int(os.environ.get("RDF_MAX_COMPUTING_MAPPINGS", "2"))
+RDF_MAX_REJECTED_MAPPINGS = int(os.environ.get("RDF_MAX_REJECTED_MAPPINGS", "5"))
+RDF_MAX_FAILED_MAPPINGS = int(os.environ.get("RDF_MAX_FAILED_MAPPINGS", "3"))
+
+# Identity cache for op, data and client lookups: none, memory or redis (shared by processes)
+RDF_CACHE = os.environ.get("RDF_CACHE", "none")
+RDF_CACHE_SIZE = int(os.environ.get("RDF_CACHE_SIZE", "10000"))
+RDF_CACHE_TTL = float(os.environ.get("RDF_CACHE_TTL", "60"))
+
+# Track idle clients in memory instead of querying mappings, only when one process writes them
+RDF_CLIENT_AVAILABILITY_INDEX = os.environ.get("RDF_CLIENT_AVAILABILITY_INDEX", "0") == "1"
+
+# Seconds unreferenced data rows and files are kept before garbage collection reclaims them
+RDF_GC_GRACE_PERIOD = float(os.environ.get("RDF_GC_GRACE_PERIOD", "3600"))
+
+# Share one file between data rows with identical contents
+RDF_DATA_DEDUP = os.environ.get("RDF_DATA_DEDUP", "0") == "1"
+
+# Compression used by the tensor store: none or zlib
+RDF_TENSOR_COMPRESSION = os.environ.get("RDF_TENSOR_COMPRESSION", "none")
+
+# Tensors of at least this many bytes are stored in tiles of about RDF_CHUNK_BYTES, 0 disables
+RDF_CHUNK_THRESHOLD = int(os.environ.get("RDF_CHUNK_THRESHOLD", str(256 * 1024 * 1024)))
+RDF_CHUNK_BYTES = int(os.environ.get("RDF_CHUNK_BYTES", str(16 * 1024 * 1024)))
+
+# Tensors smaller than RDF_HOT_TIER_THRESHOLD bytes skip the file store: none, redis or value (Data.value column)
+RDF_HOT_TIER = os.environ.get("RDF_HOT_TIER", "none")
+RDF_HOT_TIER_THRESHOLD = int(os.environ.get("RDF_HOT_TIER_THRESHOLD", "1024"))
+# Seconds redis keeps hot tensors, 0 keeps them until their data row is deleted
+RDF_HOT_TIER_TTL = int(os.environ.get("RDF_HOT_TIER_TTL", "0"))
+
+# Write tensors on background threads, their data rows stay pending until written
+RDF_WRITE_BEHIND = os.environ.get("RDF_WRITE_BEHIND", "0") == "1"
+RDF_WRITE_BEHIND_WORKERS = int(os.environ.get("RDF_WRITE_BEHIND_WORKERS", "4"))
+# create_data_complete blocks while this many background writes are outstanding
+RDF_WRITE_BEHIND_MAX_PENDING = int(os.environ.get("RDF_WRITE_BEHIND_MAX_PENDING", "64"))
+
+# Weights of an op's critical path length, fan-out and graph age (per second) in its scheduling priority
+RDF_SCHEDULER_CRITICAL_PATH_WEIGHT = float(os.environ.get("RDF_SCHEDULER_CRITICAL_PATH_WEIGHT", "1"))
+RDF_SCHEDULER_FAN_OUT_WEIGHT = float(os.environ.get("RDF_SCHEDULER_FAN_OUT_WEIGHT", "0.1"))
+RDF_SCHEDULER_AGE_WEIGHT = float(os.environ.get("RDF_SCHEDULER_AGE_WEIGHT", "0.01"))
+
+# Largest number of ops the graph compiler fuses into a chain or batches into one super-op
+RDF_COMPILER_MAX_FUSED = int(os.environ.get("RDF_COMPILER_MAX_FUSED", "16"))
+RDF_COMPILER_MAX_BATCH = int(os.environ.get("RDF_COMPILER_MAX_BATCH", "64"))
+
+# Reuse the result of an earlier op with the same operator, params and input contents
+RDF_OP_MEMO = os.environ.get("RDF_OP_MEMO", "0") == "1"
+# Most reusable results kept and seconds they stay reusable, 0 for no limit
+RDF_OP_MEMO_MAX_ENTRIES = int(os.environ.get("RDF_OP_MEMO_MAX_ENTRIES", "100000"))
+RDF_OP_MEMO_MAX_AGE = int(os.environ.get("RDF_OP_MEMO_MAX_AGE", str(7 * 24 * 3600)))
+
+# Client performance model: EWMA weight of new latencies, finished mappings it warms up from and
+# latencies sampled per operator
+RDF_CLIENT_PERF_ALPHA = float(os.environ.get("RDF_CLIENT_PERF_ALPHA", "0.2"))
+RDF_CLIENT_PERF_WARMUP = int(os.environ.get("RDF_CLIENT_PERF_WARMUP", "10000"))
+RDF_CLIENT_PERF_RESERVOIR = int(os.environ.get("RDF_CLIENT_PERF_RESERVOIR", "256"))
+# Expected latency is multiplied by 1 + penalty * failure rate
+RDF_CLIENT_FAILURE_PENALTY = float(os.environ.get("RDF_CLIENT_FAILURE_PENALTY", "4"))
+# Ops with inputs of at least this many bytes go to the fastest idle client, the fastest fraction of
+# idle clients is kept free for them
+RDF_CLIENT_LARGE_OP_BYTES = int(os.environ.get("RDF_CLIENT_LARGE_OP_BYTES", str(1024 * 1024)))
+RDF_CLIENT_FAST_FRACTION = float(os.environ.get("RDF_CLIENT_FAST_FRACTION", "0.25"))
+
+# A busy mapping is a straggler once it ran RDF_STRAGGLER_MULTIPLIER times the RDF_STRAGGLER_QUANTILE of
+# its operator's latencies, at least RDF_STRAGGLER_MIN_SECONDS, given RDF_STRAGGLER_MIN_SAMPLES latencies
+RDF_STRAGGLER_QUANTILE = float(os.environ.get("RDF_STRAGGLER_QUANTILE", "0.95"))
+RDF_STRAGGLER_MULTIPLIER = float(os.environ.get("RDF_STRAGGLER_MULTIPLIER", "1.5"))
+RDF_STRAGGLER_MIN_SECONDS = float(os.environ.get("RDF_STRAGGLER_MIN_SECONDS", "5"))
+RDF_STRAGGLER_MIN_SAMPLES = int(os.environ.get("RDF_STRAGGLER_MIN_SAMPLES", "20"))
+# Most busy mappings of one op, original included, speculation goes up to
+RDF_STRAGGLER_MAX_COPIES = int(os.environ.get("RDF_STRAGGLER_MAX_COPIES", "2"))
+
+# Where data files are stored: a directory, redis:/// or s3://bucket/prefix
+RDF_STORAGE_URI = os.environ.get("RDF_STORAGE_URI", DATA_FILES_PATH)
+# Endpoint of an S3 compatible store such as minio, None for AWS
+RDF_S3_ENDPOINT_URL = os.environ.get("RDF_S3_ENDPOINT_URL", None)
@@ -1,16 +1,33 @@
+import asyncio
 import datetime
 import json
+import threading
+import time
+import weakref
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from enum import Enum
 
 import numpy as np
 import sqlalchemy as db
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, or_
+from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, func, or_
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, scoped_session, relationship, aliased, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 from sqlalchemy_utils import database_exists, create_database as cd, drop_database as dba
 
 from . import config
-from .utils import delete_data_file, save_data_to_file, Singleton
+from .cache import LRUCache, RedisCache
+from .chunked_store import save_chunked
+from .client_index import ClientAvailabilityIndex, BUSY_MAPPING_STATUSES
+from .client_performance import ClientPerformanceModel
+from .file_sweeper import FileSweeper, find_data_files
+from .readiness import GraphReadiness, get_parent_op_ids, get_op_dependencies, get_op_fingerprint
+from .storage import get_storage
+from .tensor_store import save_tensor, save_json, load_tensor, delete_tensor, get_tensor_paths, to_ndarray, \
+    hash_tensor, tensor_exists, encode_inline, decode_inline
+from .utils import Singleton
+from .write_behind import WriteBehindWriter
 
 Base = declarative_base()
 
@@ -38,6 +55,13 @@ class ClientOpMappingStatus(Enum):
     NOT_COMPUTED = "not_computed"
     FAILED = "failed"
     REJECTED = "rejected"
+    CANCELLED = "cancelled"
+
+
+class DataStatus(Enum):
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
 
 
 class Graph(Base):
@@ -58,13 +82,23 @@ class Data(Base):
     file_path = Column(String(200), nullable=True)
     value = Column(String(100), nullable=True)
 
+    # Numpy dtype string and json encoded shape of the stored tensor
+    dtype = Column(String(20), nullable=True)
+    shape = Column(String(100), nullable=True)
+
+    # Sha256 of the tensor, rows with the same hash share one file
+    content_hash = Column(String(64), nullable=True, index=True)
+
+    # 1. pending (being written in the background) 2. ready 3. failed
+    status = Column(String(10), default="ready", server_default="ready")
+
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 
 class Client(Base):
     __tablename__ = 'client'
     id = Column(Integer, primary_key=True)
-    client_id = Column(String(100), nullable=False)
+    client_id = Column(String(100), nullable=False, index=True)
     client_ip = Column(String(20), nullable=True)
     status = Column(String(20), nullable=False, default="disconnected")
     # 1. ravop 2. ravjs
@@ -85,7 +119,7 @@ class Op(Base):
     name = Column(String(20), nullable=True)
 
     # Graph id
-    graph_id = Column(Integer, ForeignKey('graph.id'))
+    graph_id = Column(Integer, ForeignKey('graph.id'), index=True)
 
     # 1. input 2. output 3. middle
     node_type = Column(String(10), nullable=False)
@@ -101,51 +135,275 @@ class Op(Base):
     operator = Column(String(50), nullable=False)
 
     # 1. pending 2. computing 3. computed 4. failed
-    status = Column(String(10), default="pending")
+    status = Column(String(10), default="pending", index=True)
     message = Column(Text, nullable=True)
 
     # Dict of params
     params = Column(Text, nullable=True)
 
+    # Sha256 of the operator, params and input contents, set when the op became ready with RDF_OP_MEMO
+    fingerprint = Column(String(64), nullable=True, index=True)
+
+    # Number of client op mappings currently in these statuses, kept current by DBManager
+    sent_mappings = Column(Integer, nullable=False, default=0, server_default="0")
+    computing_mappings = Column(Integer, nullable=False, default=0, server_default="0")
+    rejected_mappings = Column(Integer, nullable=False, default=0, server_default="0")
+    failed_mappings = Column(Integer, nullable=False, default=0, server_default="0")
+    # At most 1, only the first computed mapping of an op wins
+    computed_mappings = Column(Integer, nullable=False, default=0, server_default="0")
+
     op_mappings = relationship("ClientOpMapping", backref="op", lazy="dynamic")
 
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 
+class OpDependency(Base):
+    __tablename__ = "op_dependency"
+    parent_op_id = Column(Integer, ForeignKey('op.id'), primary_key=True)
+    child_op_id = Column(Integer, ForeignKey('op.id'), primary_key=True, index=True)
+
+    # input:<position> or param:<name>
+    role = Column(String(50), primary_key=True)
+
+
+# Op counter column of each counted mapping status
+MAPPING_STATUS_COUNTERS = {
+    ClientOpMappingStatus.SENT.value: "sent_mappings",
+    ClientOpMappingStatus.COMPUTING.value: "computing_mappings",
+    ClientOpMappingStatus.REJECTED.value: "rejected_mappings",
+    ClientOpMappingStatus.FAILED.value: "failed_mappings",
+    ClientOpMappingStatus.COMPUTED.value: "computed_mappings"
+}
+
+
+# Mapping statuses which end an assignment, the client performance model learns from these. Cancelled
+# mappings are left out: they lost a speculative race, so their latency is censored and would drag the
+# straggler threshold upwards
+FAILED_MAPPING_STATUSES = (ClientOpMappingStatus.FAILED.value, ClientOpMappingStatus.NOT_COMPUTED.value)
+FINISHED_MAPPING_STATUSES = (ClientOpMappingStatus.COMPUTED.value,) + FAILED_MAPPING_STATUSES
+
+
+def get_mapping_latency(sent_time, response_time):
+    """
+    Seconds between sending an op to a client and its response, None if either is missing
+    """
+    if sent_time is None or response_time is None:
+        return None
+    return max((response_time - sent_time).total_seconds(), 0.0)
+
+
 class ClientOpMapping(Base):
     __tablename__ = "client_op_mapping"
     id = Column(Integer, primary_key=True)
-    client_id = Column(Integer, ForeignKey('client.id'))
-    op_id = Column(Integer, ForeignKey('op.id'))
+    client_id = Column(Integer, ForeignKey('client.id'), index=True)
+    op_id = Column(Integer, ForeignKey('op.id'), index=True)
     sent_time = Column(DateTime, default=None)
     response_time = Column(DateTime, default=None)
 
     # 1. computing 2. computed 3. failed
-    status = Column(String(10), default="computing")
+    status = Column(String(10), default="computing", index=True)
 
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 
+class TaskScope(object):
+    """
+    Session scope function which gives every asyncio task its own session
+
+    The session of a task is closed and dropped from the registry once the task is done, so
+    finished tasks don't hold on to pooled connections and a task reusing the id of a finished
+    one starts with a new session. Code outside of a task gets its thread's session.
+    """
+
+    def __init__(self):
+        self.registry = None
+        self._tasks = weakref.WeakSet()
+
+    def __call__(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+
+        if task is None:
+            return threading.get_ident()
+        if task not in self._tasks:
+            self._tasks.add(task)
+            task.add_done_callback(self._remove)
+        return id(task)
+
+    def _remove(self, task):
+        session = self.registry.registry.pop(id(task), None) if self.registry is not None else None
+        if session is not None:
+            session.close()
+
+
 @Singleton
 class DBManager(object):
     def __init__(self):
         self.create_database()
         self.engine, self.session = self.connect()
 
+        # Built on first use when RDF_CLIENT_AVAILABILITY_INDEX is enabled
+        self.client_index = None
+        # Warmed up from finished mappings on first use
+        self.client_performance = None
+
+        self.cache = self.create_cache()
+        self.file_sweeper = FileSweeper()
+        self.writer = WriteBehindWriter(max_workers=config.RDF_WRITE_BEHIND_WORKERS,
+                                        max_pending=config.RDF_WRITE_BEHIND_MAX_PENDING)
+
     def connect(self):
-        engine = db.create_engine(config.RDF_DATABASE_URI, isolation_level="READ UNCOMMITTED")
-        connection = engine.connect()
+        """
+        Create the engine and a scoped session
+
+        self.session is a registry which hands every thread (or asyncio task when
+        RDF_DB_SESSION_SCOPE is task) its own session, so concurrent callers never share a unit
+        of work. Call self.session.remove() when a thread is done with the database, sessions of
+        tasks are removed when the task finishes.
+        """
+        engine = db.create_engine(config.RDF_DATABASE_URI, isolation_level="READ UNCOMMITTED",
+                                  **self.get_pool_options())
         Base.metadata.bind = engine
         DBSession = sessionmaker(bind=engine)
-        session = DBSession()
+        if config.RDF_DB_SESSION_SCOPE == "task":
+            scope = TaskScope()
+            session = scoped_session(DBSession, scopefunc=scope)
+            scope.registry = session.registry
+        else:
+            session = scoped_session(DBSession)
         return engine, session
 
+    def get_pool_options(self):
+        """
+        Connection pool options from config, sqlite doesn't use a sized pool
+        """
+        options = {"pool_recycle": config.RDF_DB_POOL_RECYCLE, "pool_pre_ping": True}
+        if not config.RDF_DATABASE_URI.startswith("sqlite"):
+            options.update(pool_size=config.RDF_DB_POOL_SIZE, max_overflow=config.RDF_DB_MAX_OVERFLOW,
+                           pool_timeout=config.RDF_DB_POOL_TIMEOUT)
+        return options
+
+    def get_pool_status(self):
+        """
+        Get connection pool statistics
+        """
+        pool = self.engine.pool
+        status = {"pool": type(pool).__name__, "status": pool.status()}
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            if hasattr(pool, name):
+                status[name] = getattr(pool, name)()
+        return status
+
+    def create_cache(self):
+        """
+        Create the identity cache for op, data and client lookups selected by RDF_CACHE
+        """
+        if config.RDF_CACHE == "memory":
+            return LRUCache(max_size=config.RDF_CACHE_SIZE, ttl=config.RDF_CACHE_TTL)
+        elif config.RDF_CACHE == "redis":
+            from .redis_manager import RedisManager
+            return RedisCache(RedisManager.Instance().connect_binary(), ttl=config.RDF_CACHE_TTL)
+        return None
+
+    def get_cache_stats(self):
+        """
+        Get cache hit and miss counts
+        """
+        if self.cache is None:
+            return None
+        return self.cache.get_stats()
+
+    def _get_cached(self, model, id):
+        """
+        Get an object by primary key, from the cache when possible
+
+        An object the session already holds is returned as is, so its pending changes are kept.
+        Otherwise the object is rebuilt from its cached json column values and merged into the
+        session without loading it, so hits don't touch the database.
+        """
+        if self.cache is None or id is None:
+            return self.session.query(model).get(id)
+
+        obj = self.session.identity_map.get(identity_key(model, id))
+        if obj is not None:
+            return obj
+
+        key = "{}:{}".format(model.__tablename__, id)
+        value = self.cache.get(key)
+        if value is not None:
+            return self.session.merge(self._from_cache(model, value), load=False)
+
+        # An invalidation between the query and the fill makes the cache skip the maybe stale value
+        token = self.cache.reserve(key)
+        obj = self.session.query(model).get(id)
+        if obj is not None:
+            self.cache.set(key, self._to_cache(obj), token)
+        return obj
+
+    def _to_cache(self, obj):
+        values = {}
+        for column in obj.__table__.columns:
+            value = getattr(obj, column.key)
+            values[column.key] = value.isoformat() if isinstance(value, datetime.datetime) else value
+        return json.dumps(values)
+
+    def _from_cache(self, model, value):
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+
+        obj = model()
+        values = json.loads(value)
+        for column in model.__table__.columns:
+            field = values.get(column.key)
+            if field is not None and isinstance(column.type, DateTime):
+                field = datetime.datetime.fromisoformat(field)
+            setattr(obj, column.key, field)
+        # Mark the values as loaded so merge() takes the object as a clean copy of its row
+        make_transient_to_detached(obj)
+        return obj
+
+    def _invalidate(self, *objs):
+        """
+        Drop objects from the cache after they were written
+        """
+        if self.cache is not None:
+            self.cache.delete(*["{}:{}".format(obj.__tablename__, obj.id) for obj in objs if obj is not None])
+
+    def _invalidate_ids(self, model, *ids):
+        if self.cache is not None:
+            self.cache.delete(*["{}:{}".format(model.__tablename__, id) for id in ids if id is not None])
+
+    @contextmanager
+    def session_scope(self):
+        """
+        Transactional scope around a unit of work on a new session
+
+        Commits on success, rolls back on error and closes the session afterwards. The thread's or
+        task's own session is left alone, so objects it returned earlier stay attached.
+        """
+        session = self.create_session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
     def create_database(self):
         if not database_exists(config.RDF_DATABASE_URI):
             cd(config.RDF_DATABASE_URI)
             print("Database created")
 
     def drop_database(self):
+        # Finish background writes and release pooled connections so the database can be dropped
+        self.writer.flush()
+        self.session.remove()
+        self.engine.dispose()
+
         if database_exists(config.RDF_DATABASE_URI):
             dba(config.RDF_DATABASE_URI)
             print("Database dropped")
@@ -160,6 +418,44 @@ class DBManager(object):
     def create_tables(self):
         Base.metadata.create_all(self.engine)
 
+    def migrate_database(self, batch_size=1000):
+        """
+        Bring an existing database up to date with the models
+
+        Creates missing tables, columns and indexes and backfills the op dependency edges of ops
+        created before the op_dependency table existed.
+        """
+        Base.metadata.create_all(self.engine)
+
+        inspector = db.inspect(self.engine)
+        for table in Base.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            ddl_compiler = self.engine.dialect.ddl_compiler(self.engine.dialect, None)
+            for column in table.columns:
+                if column.name not in columns:
+                    # The dialect renders the type, nullability and a correctly quoted server default
+                    self.engine.execute("ALTER TABLE {} ADD COLUMN {}".format(
+                        table.name, ddl_compiler.get_column_specification(column)))
+
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(self.engine)
+
+        has_edges = self.session.query(OpDependency).filter(OpDependency.child_op_id == Op.id).exists()
+        edges = []
+        for op_id, inputs, params in self.session.query(Op.id, Op.inputs, Op.params).filter(~has_edges).all():
+            edges.extend({"parent_op_id": parent_id, "child_op_id": op_id, "role": role}
+                         for parent_id, role in get_op_dependencies(inputs, params))
+            if len(edges) >= batch_size:
+                self.session.bulk_insert_mappings(OpDependency, edges)
+                edges = []
+
+        self.session.bulk_insert_mappings(OpDependency, edges)
+        self.session.commit()
+
+        self.rebuild_mapping_counters()
+
     def refresh(self, obj):
         """
         Refresh an object
@@ -169,13 +465,13 @@ class DBManager(object):
 
     def get(self, name, id):
         if name == "op":
-            obj = self.session.query(Op).get(id)
+            obj = self._get_cached(Op, id)
         elif name == "data":
-            obj = self.session.query(Data).get(id)
+            obj = self._get_cached(Data, id)
         elif name == "graph":
             obj = self.session.query(Graph).get(id)
         elif name == "client":
-            obj = self.session.query(Client).get(id)
+            obj = self._get_cached(Client, id)
         else:
             obj = None
 
@@ -196,8 +492,15 @@ class DBManager(object):
         for key, value in kwargs.items():
             setattr(obj, key, value)
         self.session.add(obj)
+
+        if name == "op":
+            self.session.flush()
+            self._sync_op_dependencies(obj)
         self.session.commit()
 
+        if name == "client":
+            self._track_client_status(obj)
+
         return obj
 
     def update(self, name, id, **kwargs):
@@ -214,12 +517,20 @@ class DBManager(object):
 
         for key, value in kwargs.items():
             setattr(obj, key, value)
+
+        if name == "op" and ("inputs" in kwargs or "params" in kwargs):
+            self._sync_op_dependencies(obj)
         self.session.commit()
+        self._invalidate(obj)
+
+        if name == "client" and "status" in kwargs:
+            self._track_client_status(obj)
         return obj
 
     def delete(self, obj):
         self.session.delete(obj)
         self.session.commit()
+        self._invalidate(obj)
 
     def create_op(self, **kwargs):
         op = Op()
@@ -228,6 +539,8 @@ class DBManager(object):
             setattr(op, key, value)
 
         self.session.add(op)
+        self.session.flush()
+        self._sync_op_dependencies(op)
         self.session.commit()
         return op
 
@@ -235,15 +548,71 @@ class DBManager(object):
         """
         Get an existing op
         """
-        return self.session.query(Op).get(op_id)
+        return self._get_cached(Op, op_id)
+
+    def _attach(self, obj):
+        """
+        Get an object in the current thread's or task's session
+
+        An object of another session, e.g. loaded on another thread, is merged without loading it,
+        so committing the current session writes what is then set on the result. Such objects
+        can't have unsaved changes of their own.
+        """
+        if obj in self.session:
+            return obj
+        return self.session.merge(obj, load=False)
 
     def update_op(self, op, **kwargs):
+        op = self._attach(op)
         for key, value in kwargs.items():
             setattr(op, key, value)
 
+        if "inputs" in kwargs or "params" in kwargs:
+            self._sync_op_dependencies(op)
         self.session.commit()
+        self._invalidate(op)
         return op
 
+    def _sync_op_dependencies(self, op):
+        """
+        Rewrite the dependency edges of an op from its inputs and params
+        """
+        self.session.query(OpDependency).filter(OpDependency.child_op_id == op.id).delete(synchronize_session=False)
+        self.session.add_all([OpDependency(parent_op_id=parent_id, child_op_id=op.id, role=role)
+                              for parent_id, role in get_op_dependencies(op.inputs, op.params)])
+
+    def get_op_parents(self, op_id):
+        """
+        Get the ops an op depends on
+        """
+        return self.session.query(Op).join(OpDependency, OpDependency.parent_op_id == Op.id) \
+            .filter(OpDependency.child_op_id == op_id).distinct().all()
+
+    def get_op_children(self, op_id):
+        """
+        Get the ops which depend on an op
+        """
+        return self.session.query(Op).join(OpDependency, OpDependency.child_op_id == Op.id) \
+            .filter(OpDependency.parent_op_id == op_id).distinct().all()
+
+    def get_ready_ops(self, graph_id=None):
+        """
+        Get pending ops whose parents are all computed
+        """
+        parent = aliased(Op)
+        unfinished_parents = self.session.query(OpDependency).join(parent, parent.id == OpDependency.parent_op_id) \
+            .filter(OpDependency.child_op_id == Op.id, parent.status != OpStatus.COMPUTED.value)
+
+        ops = self.session.query(Op).filter(Op.status == OpStatus.PENDING.value, ~unfinished_parents.exists())
+        if graph_id is not None:
+            ops = ops.filter(Op.graph_id == graph_id)
+
+        ops = ops.order_by(Op.id).all()
+        if config.RDF_OP_MEMO:
+            # Memoized ops are computed now, their children show up on the next call
+            ops = [op for op in ops if self.memoize_op(op) is None]
+        return ops
+
     def create_data(self, **kwargs):
         data = Data()
 
@@ -258,39 +627,165 @@ class DBManager(object):
         """
         Get an existing data
         """
-        return self.session.query(Data).get(data_id)
+        return self._get_cached(Data, data_id)
 
     def update_data(self, data, **kwargs):
+        data = self._attach(data)
         for key, value in kwargs.items():
             setattr(data, key, value)
 
         self.session.commit()
+        self._invalidate(data)
         return data
 
     def delete_data(self, data_id):
         data = self.session.query(Data).get(data_id)
         self.session.delete(data)
         self.session.commit()
+        self._invalidate_ids(Data, data_id)
 
-    def create_data_complete(self, data, data_type):
-        # print("Creating data:", data)
+    def create_data_complete(self, data, data_type, write_behind=None):
+        """
+        Create a data row and store its tensor in one transaction
 
-        if isinstance(data, (np.ndarray, np.generic)):
-            if data.ndim == 1:
-                data = data[..., np.newaxis]
+        With write-behind (RDF_WRITE_BEHIND by default) the row is committed as pending right away
+        and a copy of the tensor is written by a background writer, which marks the row ready or
+        failed. This blocks while RDF_WRITE_BEHIND_MAX_PENDING writes are outstanding, flush()
+        waits for all of them.
+        """
+        if write_behind is None:
+            write_behind = config.RDF_WRITE_BEHIND
+
+        if write_behind:
+            try:
+                array = to_ndarray(self._prepare_data(data)).copy()
+            except (TypeError, ValueError):
+                # Not a tensor, stored right away as json
+                write_behind = False
+
+        d = Data(type=data_type)
+        self.session.add(d)
+        try:
+            if write_behind:
+                d.dtype = array.dtype.str
+                d.shape = json.dumps(array.shape)
+                d.status = DataStatus.PENDING.value
+                self.session.commit()
+                self.writer.submit(d.id, self._write_data, d.id, array)
+            else:
+                self.session.flush()
+                self._store_data(d, data)
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        self._invalidate(d)
 
-        d = self.create_data(type=data_type)
+        return d
 
-        # Save file
-        file_path = save_data_to_file(d.id, data, data_type)
+    def _write_data(self, data_id, array):
+        """
+        Background write of a pending data row, runs with the writer thread's own session
+        """
+        session = self.session
+        try:
+            d = session.query(Data).get(data_id)
+            if d is None:
+                return None
+
+            try:
+                file_path = self._store_data(d, array)
+                d.status = DataStatus.READY.value
+                session.commit()
+            except Exception:
+                session.rollback()
+                session.query(Data).filter(Data.id == data_id).update({"status": DataStatus.FAILED.value},
+                                                                      synchronize_session=False)
+                session.commit()
+                raise
+            finally:
+                self._invalidate_ids(Data, data_id)
+            return file_path
+        finally:
+            session.remove()
+
+    def flush(self, timeout=None):
+        """
+        Wait for background data writes, returns the number which failed
+        """
+        return self.writer.flush(timeout=timeout)
 
-        # Update file path
-        self.update(d, file_path=file_path)
+    def _store_data(self, d, data):
+        """
+        Write data to the tensor store and fill in the file path, dtype and shape of its row
 
-        return d
+        Tensors under RDF_HOT_TIER_THRESHOLD bytes go to the hot tier instead of the file store. With
+        RDF_DATA_DEDUP enabled, a tensor whose content hash is already stored reuses that file instead
+        of being written again. Data which isn't a tensor, e.g. a dict or a ragged list, is written
+        to a json file. Returns the path written, None when no file was written.
+        """
+        data = self._prepare_data(data)
+        try:
+            array = to_ndarray(data)
+        except (TypeError, ValueError):
+            d.file_path = save_json(d.id, data)
+            return d.file_path
+        d.dtype = array.dtype.str
+        d.shape = json.dumps(array.shape)
+        if config.RDF_DATA_DEDUP or config.RDF_OP_MEMO:
+            d.content_hash = hash_tensor(array)
+
+        if config.RDF_HOT_TIER != "none" and array.nbytes < config.RDF_HOT_TIER_THRESHOLD:
+            if config.RDF_HOT_TIER == "redis":
+                d.file_path, _ = save_tensor(d.id, array, compress=False, storage=get_storage("redis:///"),
+                                             ttl=config.RDF_HOT_TIER_TTL or None)
+                return d.file_path
+
+            d.value = encode_inline(array, Data.value.property.columns[0].type.length)
+            if d.value is not None:
+                d.file_path = None
+                return None
+
+        if config.RDF_DATA_DEDUP:
+            existing = self.session.query(Data.file_path).filter(Data.content_hash == d.content_hash,
+                                                                 Data.file_path.isnot(None), Data.id != d.id).first()
+            if existing is not None and tensor_exists(existing.file_path):
+                d.file_path = existing.file_path
+                return None
+
+        if 0 < config.RDF_CHUNK_THRESHOLD <= array.nbytes and array.ndim > 0:
+            d.file_path = save_chunked(d.id, array)
+        else:
+            d.file_path, _ = save_tensor(d.id, array)
+        return d.file_path
+
+    def load_data(self, data, mmap=True):
+        """
+        Load the tensor of a data row or id from whichever tier it was stored in
+        """
+        d = self.get_data(data) if isinstance(data, int) else data
+        if d.status == DataStatus.PENDING.value:
+            self.writer.wait(d.id)
+            self.session.refresh(d)
+        if d.status != DataStatus.READY.value:
+            raise ValueError("Data {} is {}".format(d.id, "still being written" if d.status == DataStatus.PENDING.value
+                                                    else "not stored, its write failed"))
+
+        if d.file_path is None and d.value is not None:
+            return decode_inline(d.value, d.dtype, json.loads(d.shape))
+        return load_tensor(d.file_path, mmap_mode="r" if mmap else None)
+
+    def _prepare_data(self, data):
+        """
+        Store 1-d arrays as column vectors
+        """
+        if isinstance(data, (np.ndarray, np.generic)):
+            if data.ndim == 1:
+                data = data[..., np.newaxis]
+        return data
 
     def get_op_status(self, op_id):
-        status = self.session.query(Op).get(op_id).status
+        status = self.get_op(op_id).status
         return status
 
     def get_graph(self, graph_id):
@@ -308,28 +803,216 @@ class DBManager(object):
         self.session.commit()
         return graph
 
+    def create_graph_with_ops(self, ops, data=None):
+        """
+        Create a new graph together with its ops and data rows in one transaction
+        """
+        graph = Graph()
+        self.session.add(graph)
+        self.session.flush()
+
+        ops, op_ids, data_ids = self.create_ops_bulk(ops, data=data, graph_id=graph.id)
+        return graph, ops, op_ids, data_ids
+
+    def create_ops_bulk(self, ops, data=None, graph_id=None):
+        """
+        Create many ops and data rows in one transaction
+
+        ops and data are lists of dicts of column values. An entry may carry a negative placeholder
+        "id" which other ops of the batch use in inputs, int params (op placeholders) and outputs
+        (data placeholders). A data entry may also carry a "value", which is written to the tensor
+        store. Returns the created ops and dicts mapping op and data placeholders to real ids.
+        """
+        data = data or []
+        written_files = []
+        try:
+            data_ids, data_rows = self._add_bulk(Data, data, ["value"])
+            for d, fields in zip(data_rows, data):
+                if "value" in fields:
+                    file_path = self._store_data(d, fields["value"])
+                    if file_path is not None:
+                        written_files.append(file_path)
+
+            defaults = {"graph_id": graph_id} if graph_id is not None else {}
+            op_ids, op_rows = self._add_bulk(Op, ops, ["inputs", "params", "outputs"], defaults=defaults)
+            for op, fields in zip(op_rows, ops):
+                op.inputs = self._resolve_placeholders(fields.get("inputs"), op_ids)
+                op.params = self._resolve_placeholders(fields.get("params"), op_ids)
+                op.outputs = self._resolve_placeholders(fields.get("outputs"), data_ids)
+                self.session.add_all([OpDependency(parent_op_id=parent_id, child_op_id=op.id, role=role)
+                                      for parent_id, role in get_op_dependencies(op.inputs, op.params)])
+
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            for file_path in written_files:
+                delete_tensor(file_path)
+            raise
+
+        return op_rows, op_ids, data_ids
+
+    def _add_bulk(self, model, rows, skip, defaults=None):
+        objs = []
+        for fields in rows:
+            obj = model(**(defaults or {}))
+            for key, value in fields.items():
+                if key != "id" and key not in skip:
+                    setattr(obj, key, value)
+            objs.append(obj)
+
+        self.session.add_all(objs)
+        self.session.flush()
+
+        ids = {fields["id"]: obj.id for fields, obj in zip(rows, objs) if fields.get("id") is not None}
+        return ids, objs
+
+    def _resolve_placeholders(self, value, ids):
+        """
+        Replace negative placeholder ids in json encoded or plain inputs, params and outputs
+        """
+        if value is None:
+            return None
+
+        decoded = json.loads(value) if isinstance(value, str) else value
+
+        def resolve(item):
+            if type(item).__name__ == "int" and item < 0:
+                if item not in ids:
+                    raise ValueError("Unknown placeholder id: {}".format(item))
+                return ids[item]
+            return item
+
+        if isinstance(decoded, dict):
+            decoded = {key: resolve(item) for key, item in decoded.items()}
+        elif isinstance(decoded, list):
+            decoded = [resolve(item) for item in decoded]
+
+        return json.dumps(decoded)
+
     def get_graph_ops(self, graph_id):
         return self.session.query(Op).filter(Op.graph_id == graph_id).all()
 
-    def delete_graph_ops(self, graph_id):
-        print("Deleting graph ops")
-        ops = self.get_graph_ops(graph_id=graph_id)
+    def delete_graph_ops(self, graph_id, background=False):
+        self.purge_graph(graph_id, delete_graph=False, background=background)
+
+    def purge_graph(self, graph_id, delete_graph=True, background=False):
+        """
+        Delete a graph's ops, their mappings, dependency edges and output data in one transaction
 
-        for op in ops:
-            print("Op id:{}".format(op.id))
-            data_ids = json.loads(op.outputs)
-            if data_ids is not None:
-                for data_id in data_ids:
-                    print("Data id:{}".format(data_id))
+        Data files are removed after the commit, on the file sweeper thread when background is set.
+        Files left behind by a crash are reclaimed by collect_garbage().
+        """
+        graph_op_ids = self.session.query(Op.id).filter(Op.graph_id == graph_id)
+
+        data_ids = set()
+        for outputs, in self.session.query(Op.outputs).filter(Op.graph_id == graph_id, Op.outputs.isnot(None)):
+            data_ids.update(json.loads(outputs) or [])
+
+        try:
+            file_paths = self._delete_data_rows(data_ids)
+            self.session.query(ClientOpMapping).filter(ClientOpMapping.op_id.in_(graph_op_ids.subquery())) \
+                .delete(synchronize_session=False)
+            self.session.query(OpDependency).filter(OpDependency.child_op_id.in_(graph_op_ids.subquery())) \
+                .delete(synchronize_session=False)
+            self.session.query(OpDependency).filter(OpDependency.parent_op_id.in_(graph_op_ids.subquery())) \
+                .delete(synchronize_session=False)
+            self.session.query(Op).filter(Op.graph_id == graph_id).delete(synchronize_session=False)
+            if delete_graph:
+                self.session.query(Graph).filter(Graph.id == graph_id).delete(synchronize_session=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        self._after_bulk_delete()
+        self.file_sweeper.sweep(file_paths, background=background)
+
+    def _delete_data_rows(self, data_ids, batch_size=500):
+        """
+        Delete data rows in the current transaction and return the files to remove
+
+        Files still referenced by other data rows are kept.
+        """
+        data_ids = list(data_ids)
+        file_paths = []
+        for start in range(0, len(data_ids), batch_size):
+            batch = data_ids[start:start + batch_size]
+            file_paths.extend(file_path for file_path, in
+                              self.session.query(Data.file_path).filter(Data.id.in_(batch)) if file_path)
+            self.session.query(Data).filter(Data.id.in_(batch)).delete(synchronize_session=False)
+
+        for data_id in data_ids:
+            file_paths.extend(get_tensor_paths(data_id))
+
+        return self._get_unreferenced_files(file_paths, batch_size=batch_size)
+
+    def _get_unreferenced_files(self, file_paths, exclude_ids=(), batch_size=500):
+        """
+        Get the files no data row, other than the excluded ones, points to
+        """
+        file_paths = list(set(file_paths))
+        referenced = set()
+        for start in range(0, len(file_paths), batch_size):
+            query = self.session.query(Data.file_path).filter(Data.file_path.in_(file_paths[start:start + batch_size]))
+            if exclude_ids:
+                query = query.filter(~Data.id.in_(exclude_ids))
+            referenced.update(file_path for file_path, in query)
+
+        return [file_path for file_path in file_paths if file_path not in referenced]
+
+    def delete_data_file(self, data_id):
+        """
+        Delete the files of a data id, except ones other data rows share with RDF_DATA_DEDUP
+        """
+        for file_path in self._get_unreferenced_files(get_tensor_paths(data_id), exclude_ids=[data_id]):
+            delete_tensor(file_path)
+
+    def _after_bulk_delete(self):
+        # Bulk deletes bypass the session, drop everything derived from the deleted rows
+        self.session.expire_all()
+        if self.cache is not None:
+            self.cache.clear()
+        self.client_index = None
 
-                    # Delete data file
-                    delete_data_file(data_id)
+    def collect_garbage(self, grace_period=None, background=False):
+        """
+        Reclaim data rows and files no op references anymore
 
-                    # Delete data object
-                    self.delete_data(data_id)
+        Counts the references to every data id from op outputs, then deletes unreferenced data
+        rows and files in DATA_FILES_PATH without a data row. Only rows and files older than the
+        grace period are touched, so data which was just created and is about to be attached to
+        an op survives. Returns the number of data rows and files collected.
+        """
+        if grace_period is None:
+            grace_period = config.RDF_GC_GRACE_PERIOD
+        cutoff = time.time() - grace_period
 
-            # Delete op object
-            self.delete(op)
+        ref_counts = Counter()
+        for outputs, in self.session.query(Op.outputs).filter(Op.outputs.isnot(None)):
+            ref_counts.update(json.loads(outputs) or [])
+
+        created_before = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace_period)
+        data_ids = {data_id for data_id, in self.session.query(Data.id)}
+        unreferenced_ids = [data_id for data_id, in self.session.query(Data.id).filter(Data.created_at < created_before)
+                            if ref_counts[data_id] == 0]
+
+        try:
+            file_paths = self._delete_data_rows(unreferenced_ids)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        self._after_bulk_delete()
+
+        if config.RDF_OP_MEMO:
+            self.evict_memoized_ops()
+
+        referenced_files = {file_path for file_path, in self.session.query(Data.file_path)}
+        orphan_files = [file_path for data_id, file_path in find_data_files(older_than=cutoff)
+                        if data_id not in data_ids and file_path not in referenced_files]
+        self.file_sweeper.sweep(file_paths + orphan_files, background=background)
+
+        return {"data": len(unreferenced_ids), "orphan_files": len(orphan_files)}
 
     def create_client(self, **kwargs):
         obj = Client()
@@ -339,24 +1022,41 @@ class DBManager(object):
 
         self.session.add(obj)
         self.session.commit()
+
+        self._track_client_status(obj)
         return obj
 
     def get_client(self, client_id):
         """
         Get an existing client
         """
-        return self.session.query(Client).get(client_id)
+        return self._get_cached(Client, client_id)
 
     def get_client_by_sid(self, sid):
         """
         Get an existing client by sid
         """
-        return self.session.query(Client).filter(Client.client_id == sid).first()
+        if self.cache is not None:
+            value = self.cache.get("client_sid:{}".format(sid))
+            if value is not None:
+                client = self.get_client(int(value))
+                if client is not None and client.client_id == sid:
+                    return client
+
+        client = self.session.query(Client).filter(Client.client_id == sid).first()
+        if self.cache is not None and client is not None:
+            self.cache.set("client_sid:{}".format(sid), str(client.id))
+        return client
 
     def update_client(self, client, **kwargs):
+        client = self._attach(client)
         for key, value in kwargs.items():
             setattr(client, key, value)
         self.session.commit()
+        self._invalidate(client)
+
+        if "status" in kwargs:
+            self._track_client_status(client)
         return client
 
     def get_all_clients(self):
@@ -385,10 +1085,18 @@ class DBManager(object):
 
         self.session.commit()
 
+        if self.cache is not None:
+            self.cache.clear()
+        if self.client_index is not None:
+            self.client_index.load([], {})
+
     def disconnect_client(self, client_id):
         client = self.get_client(client_id=client_id)
         client.status = "disconnected"
         self.session.commit()
+        self._invalidate(client)
+
+        self._track_client_status(client)
 
     def get_ops_by_name(self, op_name, graph_id=None):
         if graph_id is not None:
@@ -402,36 +1110,170 @@ class DBManager(object):
         """
         Get op readiness
         """
-        inputs = json.loads(op.inputs)
-        params = json.loads(op.params)
-
-        cs = 0
-        for input_op in inputs:
-            input_op1 = self.get_op(op_id=input_op)
-            if input_op1.status in ["pending", "computing"]:
-                return "parent_op_not_ready"
-            elif input_op1.status == "failed":
-                return "parent_op_failed"
-            elif input_op1.status == "computed":
-                cs += 1
-
-        for index, value in params.items():
-            if type(value).__name__ == "int":
-                cop = self.get_op(op_id=value)
-                if cop.status in ["pending", "computing"]:
-                    return "parent_op_not_ready"
-                elif cop.status == "failed":
-                    return "parent_op_failed"
-                elif cop.status == "computed":
-                    cs += 1
-            else:
-                cs += 1
-
-        if cs == len(inputs) + len(params.keys()):
+        parent_ids = get_parent_op_ids(op.inputs, op.params)
+        statuses = dict(self.session.query(Op.id, Op.status).filter(Op.id.in_(set(parent_ids))).all()) \
+            if parent_ids else {}
+
+        parent_statuses = [statuses.get(parent_id) for parent_id in parent_ids]
+        if "failed" in parent_statuses:
+            return "parent_op_failed"
+        elif "pending" in parent_statuses or "computing" in parent_statuses:
+            return "parent_op_not_ready"
+        elif all(status == "computed" for status in parent_statuses):
+            # With RDF_OP_MEMO an op whose result is already known is computed right away
+            if op.status == OpStatus.PENDING.value and self.memoize_op(op) is not None:
+                return "computed"
             return "ready"
         else:
             return "not_ready"
 
+    def compute_op_fingerprint(self, op):
+        """
+        Get an op's fingerprint from the content hashes of its parents' outputs
+
+        Returns None when a parent has no output or an output has no content hash, e.g. data
+        stored before RDF_OP_MEMO was enabled.
+        """
+        dependencies = get_op_dependencies(op.inputs, op.params)
+        outputs = dict(self.session.query(Op.id, Op.outputs)
+                       .filter(Op.id.in_({parent_id for parent_id, _ in dependencies}))) if dependencies else {}
+
+        data_ids = {}
+        for parent_id, role in dependencies:
+            ids = json.loads(outputs.get(parent_id) or "null")
+            if not ids:
+                return None
+            data_ids[role] = ids
+
+        all_ids = {data_id for ids in data_ids.values() for data_id in ids}
+        hashes = dict(self.session.query(Data.id, Data.content_hash).filter(Data.id.in_(all_ids))) \
+            if all_ids else {}
+        input_hashes = {}
+        for role, ids in data_ids.items():
+            if any(hashes.get(data_id) is None for data_id in ids):
+                return None
+            input_hashes[role] = [hashes[data_id] for data_id in ids]
+
+        return get_op_fingerprint(op.operator, op.op_type, op.params, input_hashes)
+
+    def memoize_op(self, op):
+        """
+        Complete a ready op from an earlier op with the same fingerprint
+
+        The op gets new output data rows sharing the earlier op's files and is marked computed.
+        Returns the op it reused, None when memoization is off or nothing matched, in which case
+        the op's fingerprint is stored so later ops can reuse its result.
+        """
+        if not config.RDF_OP_MEMO:
+            return None
+
+        # Ops without dependencies are graph inputs or generators, nothing identifies their result
+        if not get_op_dependencies(op.inputs, op.params):
+            return None
+
+        fingerprint = op.fingerprint or self.compute_op_fingerprint(op)
+        if fingerprint is None:
+            return None
+
+        matches = self.session.query(Op).filter(Op.fingerprint == fingerprint, Op.id != op.id,
+                                                Op.status == OpStatus.COMPUTED.value, Op.outputs.isnot(None))
+        if config.RDF_OP_MEMO_MAX_AGE > 0:
+            matches = matches.filter(Op.created_at >= datetime.datetime.utcnow() -
+                                     datetime.timedelta(seconds=config.RDF_OP_MEMO_MAX_AGE))
+
+        for source in matches.order_by(Op.id.desc()).limit(5):
+            data_ids = json.loads(source.outputs) or []
+            data = self.session.query(Data).filter(Data.id.in_(data_ids)).all() if data_ids else []
+            if len(data) != len(set(data_ids)) or not all(self._is_data_available(d) for d in data):
+                continue
+
+            data = {d.id: d for d in data}
+            copies = [Data(type=data[data_id].type, file_path=data[data_id].file_path, value=data[data_id].value,
+                           dtype=data[data_id].dtype, shape=data[data_id].shape,
+                           content_hash=data[data_id].content_hash) for data_id in data_ids]
+            try:
+                self.session.add_all(copies)
+                self.session.flush()
+                op.fingerprint = fingerprint
+                op.outputs = json.dumps([d.id for d in copies])
+                op.status = OpStatus.COMPUTED.value
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
+            self._invalidate(op)
+            return source
+
+        if op.fingerprint != fingerprint:
+            op.fingerprint = fingerprint
+            self.session.commit()
+            self._invalidate(op)
+        return None
+
+    def _is_data_available(self, d):
+        if d.status != DataStatus.READY.value:
+            return False
+        if d.file_path is None:
+            return d.value is not None
+        return tensor_exists(d.file_path)
+
+    def evict_memoized_ops(self, max_entries=None, max_age=None):
+        """
+        Forget fingerprints of ops older than max_age seconds or beyond the newest max_entries
+
+        Their results stay with their graphs, they are just no longer reused. Returns the number of
+        fingerprints cleared.
+        """
+        max_entries = config.RDF_OP_MEMO_MAX_ENTRIES if max_entries is None else max_entries
+        max_age = config.RDF_OP_MEMO_MAX_AGE if max_age is None else max_age
+
+        conditions = []
+        if max_age > 0:
+            conditions.append(Op.created_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=max_age))
+        if max_entries > 0:
+            newest_evicted = self.session.query(Op.id).filter(Op.fingerprint.isnot(None)) \
+                .order_by(Op.id.desc()).offset(max_entries).limit(1).scalar()
+            if newest_evicted is not None:
+                conditions.append(Op.id <= newest_evicted)
+        if not conditions:
+            return 0
+
+        try:
+            evicted = self.session.query(Op).filter(Op.fingerprint.isnot(None), or_(*conditions)) \
+                .update({"fingerprint": None}, synchronize_session=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        self.session.expire_all()
+        if self.cache is not None:
+            self.cache.clear()
+        return evicted
+
+    def get_graph_readiness(self, graph_id):
+        """
+        Get the readiness of every op of a graph
+
+        Loads all op statuses with one query and returns a GraphReadiness holding the ready,
+        blocked and failed op sets. Call its update() when an op changes status to re-evaluate
+        only that op's children.
+        """
+        statuses = dict(self.session.query(Op.id, Op.status).filter(Op.graph_id == graph_id).all())
+
+        parents = {op_id: [] for op_id in statuses}
+        edges = self.session.query(OpDependency.parent_op_id, OpDependency.child_op_id) \
+            .join(Op, Op.id == OpDependency.child_op_id).filter(Op.graph_id == graph_id)
+        for parent_id, child_id in edges:
+            parents[child_id].append(parent_id)
+
+        # Parents which live outside of the graph
+        external_ids = {parent_id for parent_ids in parents.values() for parent_id in parent_ids} - set(statuses)
+        if external_ids:
+            statuses.update(self.session.query(Op.id, Op.status).filter(Op.id.in_(external_ids)).all())
+
+        return GraphReadiness(statuses, parents)
+
     def get_ops_without_graph(self, status=None):
         """
         Get a list of all ops not associated to any graph
@@ -463,17 +1305,111 @@ class DBManager(object):
         """
         Get all clients which are available
         """
-        clients = self.session.query(Client).filter(Client.status == "connected").all()
+        if config.RDF_CLIENT_AVAILABILITY_INDEX:
+            client_ids = self.get_available_client_ids()
+            if len(client_ids) == 0:
+                return []
+            return self.session.query(Client).filter(Client.id.in_(client_ids)).all()
+
+        busy_mappings = self.session.query(ClientOpMapping).filter(
+            ClientOpMapping.client_id == Client.id, ClientOpMapping.status.in_(BUSY_MAPPING_STATUSES))
+
+        return self.session.query(Client).filter(Client.status == "connected", ~busy_mappings.exists()).all()
+
+    def get_available_client_ids(self):
+        """
+        Get the ids of available clients from the in-memory availability index
+        """
+        return self.get_client_index().get_idle()
+
+    def get_client_index(self):
+        """
+        Get the client availability index, loading it with one query per table on first use
+        """
+        if self.client_index is None:
+            client_index = ClientAvailabilityIndex()
+            connected_ids = [client_id for client_id, in
+                             self.session.query(Client.id).filter(Client.status == "connected")]
+            busy_counts = self.session.query(ClientOpMapping.client_id, func.count(ClientOpMapping.id)) \
+                .filter(ClientOpMapping.status.in_(BUSY_MAPPING_STATUSES)).group_by(ClientOpMapping.client_id).all()
+            client_index.load(connected_ids, dict(busy_counts))
+            self.client_index = client_index
+        return self.client_index
+
+    def _track_client_status(self, client):
+        if self.client_index is not None:
+            self.client_index.set_status(client.id, client.status)
+
+    def _track_mapping(self, old_client_id, old_status, mapping):
+        if self.client_index is not None:
+            self.client_index.update_mapping(old_client_id, old_status, mapping.client_id, mapping.status)
+
+    def get_client_performance(self):
+        """
+        Get the client performance model, warmed up from the last RDF_CLIENT_PERF_WARMUP finished
+        mappings on first use
+        """
+        if self.client_performance is None:
+            model = ClientPerformanceModel(alpha=config.RDF_CLIENT_PERF_ALPHA,
+                                           reservoir_size=config.RDF_CLIENT_PERF_RESERVOIR,
+                                           failure_penalty=config.RDF_CLIENT_FAILURE_PENALTY)
+            mappings = self.session.query(ClientOpMapping.client_id, Op.operator, ClientOpMapping.status,
+                                          ClientOpMapping.sent_time, ClientOpMapping.response_time) \
+                .join(Op, Op.id == ClientOpMapping.op_id) \
+                .filter(ClientOpMapping.status.in_(FINISHED_MAPPING_STATUSES)) \
+                .order_by(ClientOpMapping.id.desc()).limit(config.RDF_CLIENT_PERF_WARMUP).all()
+            for client_id, operator, status, sent_time, response_time in reversed(mappings):
+                model.record(client_id, operator, latency=get_mapping_latency(sent_time, response_time),
+                             failed=status in FAILED_MAPPING_STATUSES)
+            self.client_performance = model
+        return self.client_performance
+
+    def _track_performance(self, mapping):
+        if self.client_performance is None or mapping.status not in FINISHED_MAPPING_STATUSES:
+            return
+
+        operator, = self.session.query(Op.operator).filter(Op.id == mapping.op_id).one()
+        response_time = mapping.response_time or datetime.datetime.utcnow()
+        self.client_performance.record(mapping.client_id, operator,
+                                       latency=get_mapping_latency(mapping.sent_time, response_time),
+                                       failed=mapping.status in FAILED_MAPPING_STATUSES)
+
+    def get_op_input_size(self, op):
+        """
+        Get the number of bytes of an op's inputs from the dtype and shape of its parents' outputs
+        """
+        parent_ids = get_parent_op_ids(op.inputs, op.params)
+        if not parent_ids:
+            return 0
+
+        data_ids = set()
+        for outputs, in self.session.query(Op.outputs).filter(Op.id.in_(set(parent_ids)), Op.outputs.isnot(None)):
+            data_ids.update(json.loads(outputs) or [])
+        if not data_ids:
+            return 0
+
+        size = 0
+        for dtype, shape in self.session.query(Data.dtype, Data.shape).filter(Data.id.in_(data_ids)):
+            if dtype is not None and shape is not None:
+                size += int(np.prod(json.loads(shape), dtype=np.int64)) * np.dtype(dtype).itemsize
+        return size
+
+    def select_client_for_op(self, op, client_ids=None):
+        """
+        Pick the idle client expected to finish an op soonest, None when no client is idle
 
-        client_list = []
-        for client in clients:
-            client_ops = client.client_ops.filter(or_(ClientOpMapping.status == ClientOpMappingStatus.SENT,
-                                                      ClientOpMapping.status == ClientOpMappingStatus.ACKNOWLEDGED.value,
-                                                      ClientOpMapping.status == ClientOpMappingStatus.COMPUTING.value))
-            if client_ops.count() == 0:
-                client_list.append(client)
+        Ops with inputs of at least RDF_CLIENT_LARGE_OP_BYTES go to the fastest client, smaller
+        ones leave the fastest RDF_CLIENT_FAST_FRACTION of idle clients free for them.
+        """
+        if client_ids is None:
+            client_ids = [client.id for client in self.get_available_clients()]
+        if len(client_ids) == 0:
+            return None
 
-        return client_list
+        large = self.get_op_input_size(op) >= config.RDF_CLIENT_LARGE_OP_BYTES
+        client_id = self.get_client_performance().select(client_ids, op.operator, large=large,
+                                                          fast_fraction=config.RDF_CLIENT_FAST_FRACTION)
+        return self.get_client(client_id)
 
     def get_ops(self, graph_id=None, status=None):
         """
@@ -498,39 +1434,203 @@ class DBManager(object):
             setattr(mapping, key, value)
 
         self.session.add(mapping)
+        self.session.flush()
+        self._count_mapping_status(mapping.op_id, mapping.status, 1)
         self.session.commit()
+        self._invalidate_ids(Op, mapping.op_id)
+
+        self._track_mapping(None, None, mapping)
         return mapping
 
     def update_client_op_mapping(self, client_op_mapping_id, **kwargs):
-        mapping = self.session.query(ClientOpMapping).get(client_op_mapping_id)
+        """
+        Update a client op mapping and the mapping counters of its op
+
+        The mapping row is locked first so its old status is current. Setting a mapping computed
+        when another mapping of its op already is cancels it instead, as it lost the race for the
+        op's result, so check the status of the returned mapping.
+        """
+        mapping = self._lock_client_op_mapping(client_op_mapping_id)
+        old_client_id, old_op_id, old_status = mapping.client_id, mapping.op_id, mapping.status
         for key, value in kwargs.items():
             setattr(mapping, key, value)
+
+        if mapping.op_id != old_op_id or mapping.status != old_status:
+            self._count_mapping_status(old_op_id, old_status, -1)
+            if mapping.status == ClientOpMappingStatus.COMPUTED.value and not self._claim_op_result(mapping.op_id):
+                mapping.status = ClientOpMappingStatus.CANCELLED.value
+            elif mapping.status != ClientOpMappingStatus.COMPUTED.value:
+                self._count_mapping_status(mapping.op_id, mapping.status, 1)
         self.session.commit()
+        self._invalidate_ids(Op, old_op_id, mapping.op_id)
+
+        self._track_mapping(old_client_id, old_status, mapping)
+        if mapping.status != old_status:
+            self._track_performance(mapping)
+            if mapping.status == ClientOpMappingStatus.COMPUTED.value:
+                self.cancel_op_mappings(mapping.op_id, exclude_id=mapping.id)
         return mapping
 
+    def _lock_client_op_mapping(self, client_op_mapping_id):
+        """
+        Load a mapping and lock its row until the end of the transaction
+        """
+        return self.session.query(ClientOpMapping).filter(ClientOpMapping.id == client_op_mapping_id) \
+            .with_for_update().populate_existing().one()
+
+    def _claim_op_result(self, op_id):
+        """
+        Count a computed mapping of an op unless one is counted already, returns whether it was
+
+        The conditional update on the op's row decides between concurrent results, on every
+        database, as the second update waits for the first and then no longer matches.
+        """
+        return self.session.query(Op).filter(Op.id == op_id, Op.computed_mappings == 0) \
+            .update({Op.computed_mappings: Op.computed_mappings + 1}, synchronize_session=False) == 1
+
+    def complete_client_op_mapping(self, client_op_mapping_id, status=ClientOpMappingStatus.COMPUTED.value,
+                                   response_time=None):
+        """
+        Record a client's response to an op, the first result of a speculatively duplicated op wins
+
+        Returns the mapping and whether its result should be used. A mapping which is no longer
+        busy, e.g. cancelled, loses and is left as is, a computed one whose op another mapping
+        computed first loses and is cancelled. A winning computed mapping cancels the op's other
+        busy mappings.
+        """
+        mapping = self._lock_client_op_mapping(client_op_mapping_id)
+        if mapping.status not in BUSY_MAPPING_STATUSES:
+            self.session.commit()
+            return mapping, False
+
+        mapping = self.update_client_op_mapping(client_op_mapping_id, status=status,
+                                                response_time=response_time or datetime.datetime.utcnow())
+        return mapping, mapping.status == status
+
+    def cancel_op_mappings(self, op_id, exclude_id=None):
+        """
+        Cancel the busy mappings of an op, e.g. the losers of a speculative race, returns them
+
+        The clients of the returned mappings should be told to stop working on the op.
+        """
+        mappings = self.session.query(ClientOpMapping).filter(ClientOpMapping.op_id == op_id,
+                                                              ClientOpMapping.status.in_(BUSY_MAPPING_STATUSES))
+        if exclude_id is not None:
+            mappings = mappings.filter(ClientOpMapping.id != exclude_id)
+
+        return [self.update_client_op_mapping(mapping.id, status=ClientOpMappingStatus.CANCELLED.value,
+                                              response_time=datetime.datetime.utcnow())
+                for mapping in mappings.all()]
+
+    def get_straggler_threshold(self, operator):
+        """
+        Seconds after which a mapping of an operator is a straggler, None without enough history
+
+        RDF_STRAGGLER_MULTIPLIER times the RDF_STRAGGLER_QUANTILE of the operator's latencies
+        sampled by the client performance model, at least RDF_STRAGGLER_MIN_SECONDS.
+        """
+        model = self.get_client_performance()
+        if model.get_sample_count(operator) < config.RDF_STRAGGLER_MIN_SAMPLES:
+            return None
+        quantile = model.get_latency_quantile(operator, config.RDF_STRAGGLER_QUANTILE)
+        return max(config.RDF_STRAGGLER_MIN_SECONDS, config.RDF_STRAGGLER_MULTIPLIER * quantile)
+
+    def find_stragglers(self, now=None):
+        """
+        Get (op, mappings) of ops whose every busy mapping was sent longer than the straggler
+        threshold of the op's operator ago and which have fewer than RDF_STRAGGLER_MAX_COPIES of them
+        """
+        now = now or datetime.datetime.utcnow()
+        mappings = self.session.query(ClientOpMapping, Op.operator).join(Op, Op.id == ClientOpMapping.op_id) \
+            .filter(ClientOpMapping.status.in_(BUSY_MAPPING_STATUSES),
+                    Op.status.in_([OpStatus.PENDING.value, OpStatus.COMPUTING.value])) \
+            .order_by(ClientOpMapping.op_id, ClientOpMapping.id).all()
+
+        thresholds = {}
+        busy = defaultdict(list)
+        straggling = defaultdict(list)
+        for mapping, operator in mappings:
+            busy[mapping.op_id].append(mapping)
+            if operator not in thresholds:
+                thresholds[operator] = self.get_straggler_threshold(operator)
+            threshold = thresholds[operator]
+            if threshold is not None and mapping.sent_time is not None and \
+                    (now - mapping.sent_time).total_seconds() > threshold:
+                straggling[mapping.op_id].append(mapping)
+
+        op_ids = [op_id for op_id, op_mappings in straggling.items()
+                  if len(op_mappings) == len(busy[op_id]) < config.RDF_STRAGGLER_MAX_COPIES]
+        return [(self.get_op(op_id), straggling[op_id]) for op_id in op_ids]
+
+    def speculate_stragglers(self, now=None):
+        """
+        Send a speculative copy of every straggling op to another idle client
+
+        Picks the client with select_client_for_op() among idle clients which don't have a
+        mapping for the op yet. Returns the new mappings, the socket layer sends their ops out.
+        """
+        idle_ids = [client.id for client in self.get_available_clients()]
+        created = []
+        for op, op_mappings in self.find_stragglers(now=now):
+            taken = {client_id for client_id, in
+                     self.session.query(ClientOpMapping.client_id).filter(ClientOpMapping.op_id == op.id)}
+            candidates = [client_id for client_id in idle_ids if client_id not in taken]
+            client = self.select_client_for_op(op, client_ids=candidates) if candidates else None
+            if client is None:
+                continue
+
+            created.append(self.create_client_op_mapping(client_id=client.id, op_id=op.id,
+                                                         sent_time=datetime.datetime.utcnow(),
+                                                         status=ClientOpMappingStatus.SENT.value))
+            idle_ids.remove(client.id)
+        return created
+
     def find_client_op_mapping(self, client_id, op_id):
         mapping = self.session.query(ClientOpMapping).filter(ClientOpMapping.client_id == client_id,
                                                              ClientOpMapping.op_id == op_id).first()
         return mapping
 
-    def get_incomplete_op(self):
-        ops = self.session.query(Op).filter(Op.status == OpStatus.COMPUTING.value).all()
-
-        for op in ops:
-            op_mappings = op.op_mappings
-            if op_mappings.filter(ClientOpMapping.status == ClientOpMappingStatus.SENT.value).count() >= 3 or \
-                    op_mappings.filter(ClientOpMapping.status == ClientOpMappingStatus.COMPUTING.value).count() >= 2 \
-                    or op_mappings.filter(ClientOpMapping.status == ClientOpMappingStatus.REJECTED.value).count() >= 5 \
-                    or op_mappings.filter(ClientOpMapping.status == ClientOpMappingStatus.FAILED.value).count() >= 3:
-                continue
+    def _count_mapping_status(self, op_id, status, delta):
+        """
+        Adjust the op counter of a mapping status in the current transaction
+        """
+        name = MAPPING_STATUS_COUNTERS.get(status)
+        if op_id is None or name is None:
+            return
 
-            return op
-        return None
+        column = getattr(Op, name)
+        self.session.query(Op).filter(Op.id == op_id).update({column: column + delta}, synchronize_session=False)
+
+    def rebuild_mapping_counters(self):
+        """
+        Recompute the mapping status counters of every op from the client op mappings
+        """
+        counts = self.session.query(ClientOpMapping.op_id, ClientOpMapping.status, func.count(ClientOpMapping.id)) \
+            .filter(ClientOpMapping.status.in_(MAPPING_STATUS_COUNTERS.keys())) \
+            .group_by(ClientOpMapping.op_id, ClientOpMapping.status).all()
+
+        self.session.query(Op).update({name: 0 for name in MAPPING_STATUS_COUNTERS.values()},
+                                      synchronize_session=False)
+        for op_id, status, count in counts:
+            if op_id is not None:
+                self.session.query(Op).filter(Op.id == op_id) \
+                    .update({MAPPING_STATUS_COUNTERS[status]: count}, synchronize_session=False)
+        self.session.commit()
+
+        if self.cache is not None:
+            self.cache.clear()
+
+    def get_incomplete_op(self):
+        return self.session.query(Op).filter(Op.status == OpStatus.COMPUTING.value,
+                                             Op.sent_mappings < config.RDF_MAX_SENT_MAPPINGS,
+                                             Op.computing_mappings < config.RDF_MAX_COMPUTING_MAPPINGS,
+                                             Op.rejected_mappings < config.RDF_MAX_REJECTED_MAPPINGS,
+                                             Op.failed_mappings < config.RDF_MAX_FAILED_MAPPINGS) \
+            .order_by(Op.id).first()
 
     def get_op_status_final(self, op_id):
         op = self.get_op(op_id=op_id)
-        op_mappings = op.op_mappings
-        if op_mappings.filter(ClientOpMapping.status == ClientOpMappingStatus.FAILED.value).count() >= 3:
+        if op.failed_mappings >= config.RDF_MAX_FAILED_MAPPINGS:
             return "failed"
 
         return "computing"
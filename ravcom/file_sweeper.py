@@ -0,0 +1,79 @@
+import os
+import queue
+import re
+import threading
+
+from .storage import LocalStorage, get_storage
+
+DATA_FILE_PATTERN = re.compile(r"^data_(\d+)\.")
+
+
+class FileSweeper(object):
+    """
+    Deletes data files, either inline or on a background thread
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def sweep(self, file_paths, background=False):
+        """
+        Delete files, returns the number deleted when run inline
+        """
+        file_paths = [file_path for file_path in file_paths if file_path is not None]
+        if not background:
+            return self._delete(file_paths)
+
+        self._start()
+        self.queue.put(file_paths)
+        return None
+
+    def join(self):
+        """
+        Wait until every background sweep finished
+        """
+        self.queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="file-sweeper", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            file_paths = self.queue.get()
+            try:
+                self._delete(file_paths)
+            finally:
+                self.queue.task_done()
+
+    def _delete(self, file_paths):
+        deleted = 0
+        for file_path in file_paths:
+            if get_storage(file_path).delete(file_path):
+                deleted += 1
+        return deleted
+
+
+def find_data_files(older_than=None):
+    """
+    List (data id, path) of the files in the local data directory, optionally only those not modified since older_than
+
+    Remote backends aren't listed, their orphans are left to the store's own lifecycle rules.
+    """
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        return []
+
+    files = []
+    for entry in os.scandir(storage.root):
+        match = DATA_FILE_PATTERN.match(entry.name)
+        if match is None or not entry.is_file():
+            continue
+        if older_than is not None and entry.stat().st_mtime > older_than:
+            continue
+        files.append((int(match.group(1)), entry.path))
+    return files
@@ -0,0 +1,141 @@
+import hashlib
+import json
+from collections import defaultdict
+
+
+def get_op_dependencies(inputs, params):
+    """
+    Get (parent op id, role) pairs from an op's json encoded inputs and params
+
+    The role is input:<position> for inputs and param:<name> for op ids passed as params.
+    """
+    dependencies = []
+
+    if inputs is not None:
+        for index, value in enumerate(json.loads(inputs) or []):
+            dependencies.append((value, "input:{}".format(index)))
+
+    if params is not None:
+        for name, value in (json.loads(params) or {}).items():
+            if type(value).__name__ == "int":
+                dependencies.append((value, "param:{}".format(name)))
+
+    return dependencies
+
+
+def get_parent_op_ids(inputs, params):
+    """
+    Get the ids of the ops an op depends on from its json encoded inputs and params
+    """
+    return [parent_id for parent_id, _ in get_op_dependencies(inputs, params)]
+
+
+def get_op_fingerprint(operator, op_type, params, input_hashes):
+    """
+    Sha256 hex digest identifying an op's computation
+
+    Covers the operator, the op type, the literal params and input_hashes, which maps the role of
+    every dependency (see get_op_dependencies) to the content hash of its output. Ops with the
+    same fingerprint compute the same result.
+    """
+    literal_params = {name: value for name, value in (json.loads(params) or {}).items()
+                      if type(value).__name__ != "int"} if params is not None else {}
+    key = json.dumps({"operator": operator, "op_type": op_type, "params": literal_params,
+                      "inputs": input_hashes}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _is_waiting(status):
+    return status not in ("computed", "failed")
+
+
+class GraphReadiness(object):
+    """
+    In-memory readiness index of the pending ops of a graph
+
+    Every pending op lands in exactly one of the ready, blocked (a parent is still pending or
+    computing) and failed (a parent failed) sets. Each op keeps a count of its unfinished and
+    failed parents, so update() only re-evaluates the children of the op that changed.
+    """
+
+    def __init__(self, statuses, parents):
+        self.statuses = dict(statuses)
+        self.parents = parents
+        self.children = defaultdict(list)
+
+        self.ready = set()
+        self.blocked = set()
+        self.failed = set()
+
+        self._waiting = defaultdict(int)
+        self._failed = defaultdict(int)
+
+        for op_id, parent_ids in parents.items():
+            for parent_id in parent_ids:
+                self.children[parent_id].append(op_id)
+                status = self.statuses.get(parent_id)
+                if status == "failed":
+                    self._failed[op_id] += 1
+                elif _is_waiting(status):
+                    self._waiting[op_id] += 1
+
+        for op_id in parents:
+            self._evaluate(op_id)
+
+    def _evaluate(self, op_id):
+        self.ready.discard(op_id)
+        self.blocked.discard(op_id)
+        self.failed.discard(op_id)
+
+        if self.statuses.get(op_id) != "pending":
+            return
+
+        if self._failed[op_id] > 0:
+            self.failed.add(op_id)
+        elif self._waiting[op_id] > 0:
+            self.blocked.add(op_id)
+        else:
+            self.ready.add(op_id)
+
+    def get_op_readiness(self, op_id):
+        """
+        Get op readiness, same values as DBManager.get_op_readiness
+        """
+        if self._failed[op_id] > 0:
+            return "parent_op_failed"
+        elif self._waiting[op_id] > 0:
+            return "parent_op_not_ready"
+        return "ready"
+
+    def update(self, op_id, status):
+        """
+        Record a status change and return the ops which became ready because of it
+        """
+        old_status = self.statuses.get(op_id)
+        self.statuses[op_id] = status
+        if old_status == status:
+            return set()
+
+        children = self.children.get(op_id, [])
+        for child_id in children:
+            if old_status == "failed":
+                self._failed[child_id] -= 1
+            elif _is_waiting(old_status):
+                self._waiting[child_id] -= 1
+
+            if status == "failed":
+                self._failed[child_id] += 1
+            elif _is_waiting(status):
+                self._waiting[child_id] += 1
+
+        if op_id in self.parents:
+            self._evaluate(op_id)
+
+        newly_ready = set()
+        for child_id in set(children):
+            was_ready = child_id in self.ready
+            self._evaluate(child_id)
+            if not was_ready and child_id in self.ready:
+                newly_ready.add(child_id)
+
+        return newly_ready
@@ -1,57 +1,467 @@
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager
+
 import redis
-from .config import RDF_REDIS_HOST, RDF_REDIS_PORT, RDF_REDIS_DB, QUEUE_LOW_PRIORITY, \
-    QUEUE_HIGH_PRIORITY, QUEUE_COMPUTING
+from . import config
+from .config import QUEUE_LOW_PRIORITY, QUEUE_HIGH_PRIORITY, QUEUE_COMPUTING, QUEUE_READY, \
+    RDF_QUEUE_VISIBILITY_TIMEOUT, RDF_QUEUE_REAPER_INTERVAL
 from .utils import Singleton
 
+# KEYS[1] is the queue list and KEYS[2] the set of its members in every script below
+# KEYS[5] is the queue's notify list, which holds one token while the queue may have values so
+# blocking pops can wait on it
+PUSH_SCRIPT = """
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    if redis.call('EXISTS', KEYS[5]) == 0 then
+        redis.call('RPUSH', KEYS[5], 1)
+    end
+    return redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+return -1
+"""
+
+PUSH_MANY_SCRIPT = """
+local pushed = 0
+for _, value in ipairs(ARGV) do
+    if redis.call('SADD', KEYS[2], value) == 1 then
+        redis.call('RPUSH', KEYS[1], value)
+        pushed = pushed + 1
+    end
+end
+if pushed > 0 and redis.call('EXISTS', KEYS[5]) == 0 then
+    redis.call('RPUSH', KEYS[5], 1)
+end
+return pushed
+"""
+
+# KEYS holds (queue, members, notify) triples in priority order. Pops leave a token in the notify
+# list of every non-empty queue, so the next blocked pop wakes up for the values left behind
+SYNC_NOTIFY_SCRIPT = """
+for i = 1, #KEYS, 3 do
+    if redis.call('LLEN', KEYS[i]) == 0 then
+        redis.call('DEL', KEYS[i + 2])
+    elseif redis.call('EXISTS', KEYS[i + 2]) == 0 then
+        redis.call('RPUSH', KEYS[i + 2], 1)
+    end
+end
+"""
+
+POP_FIRST_SCRIPT = """
+local value = false
+for i = 1, #KEYS, 3 do
+    value = redis.call('LPOP', KEYS[i])
+    if value then
+        redis.call('SREM', KEYS[i + 1], value)
+        break
+    end
+end
+""" + SYNC_NOTIFY_SCRIPT + """
+return value
+"""
+
+POP_MANY_SCRIPT = """
+local count = tonumber(ARGV[1])
+local values = {}
+for i = 1, #KEYS, 3 do
+    while #values < count do
+        local value = redis.call('LPOP', KEYS[i])
+        if not value then
+            break
+        end
+        redis.call('SREM', KEYS[i + 1], value)
+        values[#values + 1] = value
+    end
+end
+""" + SYNC_NOTIFY_SCRIPT + """
+return values
+"""
+
+REMOVE_SCRIPT = """
+redis.call('SREM', KEYS[2], ARGV[1])
+return redis.call('LREM', KEYS[1], 0, ARGV[1])
+"""
+
+SET_SCRIPT = """
+local old = redis.call('LINDEX', KEYS[1], ARGV[1])
+local result = redis.call('LSET', KEYS[1], ARGV[1], ARGV[2])
+if old then
+    redis.call('SREM', KEYS[2], old)
+end
+redis.call('SADD', KEYS[2], ARGV[2])
+return result
+"""
+
+# KEYS[3] is the sorted set of in-flight values scored by deadline, KEYS[4] maps them to consumers
+RELIABLE_POP_SCRIPT = """
+local value = redis.call('LPOP', KEYS[1])
+if value then
+    redis.call('SREM', KEYS[2], value)
+    redis.call('ZADD', KEYS[3], ARGV[1], value)
+    redis.call('HSET', KEYS[4], value, ARGV[2])
+end
+return value
+"""
+
+ACK_SCRIPT = """
+redis.call('HDEL', KEYS[4], ARGV[1])
+return redis.call('ZREM', KEYS[3], ARGV[1])
+"""
+
+NACK_SCRIPT = """
+if redis.call('ZREM', KEYS[3], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HDEL', KEYS[4], ARGV[1])
+if redis.call('SADD', KEYS[2], ARGV[1]) == 1 then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+    if redis.call('EXISTS', KEYS[5]) == 0 then
+        redis.call('RPUSH', KEYS[5], 1)
+    end
+end
+return 1
+"""
+
+REAP_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+for _, value in ipairs(expired) do
+    redis.call('ZREM', KEYS[3], value)
+    redis.call('HDEL', KEYS[4], value)
+    if redis.call('SADD', KEYS[2], value) == 1 then
+        redis.call('LPUSH', KEYS[1], value)
+        if redis.call('EXISTS', KEYS[5]) == 0 then
+            redis.call('RPUSH', KEYS[5], 1)
+        end
+    end
+end
+return expired
+"""
+
+# KEYS[3], KEYS[4] and KEYS[5] are the destination queue, its members and its notify list
+MOVE_SCRIPT = """
+local removed = redis.call('LREM', KEYS[1], 0, ARGV[1])
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('SADD', KEYS[4], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+    if redis.call('EXISTS', KEYS[5]) == 0 then
+        redis.call('RPUSH', KEYS[5], 1)
+    end
+end
+return removed
+"""
+
+REBUILD_INDEX_SCRIPT = """
+redis.call('DEL', KEYS[2])
+local values = redis.call('LRANGE', KEYS[1], 0, -1)
+for _, value in ipairs(values) do
+    redis.call('SADD', KEYS[2], value)
+end
+return #values
+"""
+
 
 @Singleton
 class RedisManager(object):
     def __init__(self):
-        self.r = redis.Redis(host=RDF_REDIS_HOST, port=RDF_REDIS_PORT, db=RDF_REDIS_DB, decode_responses=True)
+        self.pool = self.create_pool()
+        self.r = redis.Redis(connection_pool=self.pool)
+
+        # Separate pool which doesn't decode responses, for binary payloads
+        self.binary_pool = self.create_pool(decode_responses=False)
+        self.binary_r = redis.Redis(connection_pool=self.binary_pool)
+
+    def create_pool(self, decode_responses=True):
+        """
+        Create a connection pool from RDF_REDIS_URI, or RDF_REDIS_UNIX_SOCKET when it is set
+        """
+        options = {
+            "max_connections": config.RDF_REDIS_MAX_CONNECTIONS,
+            "socket_timeout": config.RDF_REDIS_SOCKET_TIMEOUT,
+            "health_check_interval": config.RDF_REDIS_HEALTH_CHECK_INTERVAL,
+            "decode_responses": decode_responses
+        }
+
+        if config.RDF_REDIS_UNIX_SOCKET:
+            return redis.ConnectionPool(connection_class=redis.UnixDomainSocketConnection,
+                                        path=config.RDF_REDIS_UNIX_SOCKET, db=int(config.RDF_REDIS_DB), **options)
+
+        return redis.ConnectionPool.from_url(config.RDF_REDIS_URI,
+                                             socket_connect_timeout=config.RDF_REDIS_SOCKET_CONNECT_TIMEOUT,
+                                             **options)
 
     def connect(self):
         return self.r
 
+    def connect_binary(self):
+        return self.binary_r
+
+    @contextmanager
+    def pipeline(self, transaction=True):
+        """
+        Group commands into one round trip, executed (as a MULTI/EXEC transaction by default) on exit
+
+        RavQueue methods join it through their pipe argument.
+        """
+        pipe = self.r.pipeline(transaction=transaction)
+        try:
+            yield pipe
+            pipe.execute()
+        finally:
+            pipe.reset()
+
 
 class RavQueue(object):
+    """
+    Deduplicating redis queue
+
+    The list keeps the order and a companion set of its members makes push-if-absent, remove and
+    membership checks atomic and O(1). Queues created before the set existed need rebuild_index().
+    A notify list holding a token while the queue may have values is what blocking pops wait on.
+
+    pop_reliable() moves a value into an in-flight set with a deadline instead of dropping it. The
+    consumer then calls ack() once the value is handled or nack() to requeue it, and
+    requeue_expired() puts values whose deadline passed back at the front of the queue.
+
+    Methods taking a pipe argument queue their command on that pipeline instead of running it,
+    see RedisManager.pipeline().
+    """
+
     def __init__(self, name):
         self.queue_name = name
+        self.members_name = "{}:members".format(name)
+        self.in_flight_name = "{}:in_flight".format(name)
+        self.consumers_name = "{}:consumers".format(name)
+        self.notify_name = "{}:notify".format(name)
         redis_manager = RedisManager.Instance()
         self.r = redis_manager.connect()
 
-    def push(self, value):
-        if self.search(value) == -1:
-            return self.r.rpush(self.queue_name, value)
-        else:
-            return -1
+        self._push = self.r.register_script(PUSH_SCRIPT)
+        self._push_many = self.r.register_script(PUSH_MANY_SCRIPT)
+        self._consumer = None
+        self._remove = self.r.register_script(REMOVE_SCRIPT)
+        self._set = self.r.register_script(SET_SCRIPT)
+        self._rebuild_index = self.r.register_script(REBUILD_INDEX_SCRIPT)
+        self._reliable_pop = self.r.register_script(RELIABLE_POP_SCRIPT)
+        self._ack = self.r.register_script(ACK_SCRIPT)
+        self._nack = self.r.register_script(NACK_SCRIPT)
+        self._reap = self.r.register_script(REAP_SCRIPT)
+        self._move = self.r.register_script(MOVE_SCRIPT)
+
+    @property
+    def keys(self):
+        return [self.queue_name, self.members_name, self.in_flight_name, self.consumers_name, self.notify_name]
+
+    def _client(self, pipe):
+        return self.r if pipe is None else pipe
+
+    def push(self, value, pipe=None):
+        return self._push(keys=self.keys, args=[value], client=self._client(pipe))
+
+    def push_many(self, values, pipe=None):
+        """
+        Push every value which isn't queued yet, returns the number of values pushed
+        """
+        values = list(values)
+        if len(values) == 0:
+            return 0
+        return self._push_many(keys=self.keys, args=values, client=self._client(pipe))
+
+    def pop(self, timeout=None, pipe=None):
+        """
+        Pop the first value, waiting up to timeout seconds (0 waits forever) if the queue is empty
+        """
+        return self.consumer.pop(timeout=timeout, pipe=pipe)
 
-    def pop(self):
-        return self.r.lpop(self.queue_name)
+    def pop_many(self, count):
+        """
+        Pop up to count values in one round trip
+        """
+        return self.consumer.pop_many(count)
+
+    def __aiter__(self):
+        return self.consumer.iterate()
+
+    @property
+    def consumer(self):
+        if self._consumer is None:
+            self._consumer = PriorityRavQueue([self])
+        return self._consumer
 
     def __len__(self):
         return self.r.llen(self.queue_name)
 
-    def remove(self, value):
-        self.r.lrem(self.queue_name, count=0, value=value)
+    def __contains__(self, value):
+        return self.r.sismember(self.members_name, value)
+
+    def remove(self, value, pipe=None):
+        self._remove(keys=self.keys, args=[value], client=self._client(pipe))
+
+    def move(self, value, destination, pipe=None):
+        """
+        Atomically move a value from this queue to the end of the destination queue
+        """
+        return self._move(keys=[self.queue_name, self.members_name, destination.queue_name,
+                                destination.members_name, destination.notify_name], args=[value],
+                          client=self._client(pipe))
+
+    def pop_reliable(self, consumer, visibility_timeout=None, pipe=None):
+        """
+        Pop a value and keep it in flight until it is acked or its visibility timeout expires
+        """
+        if visibility_timeout is None:
+            visibility_timeout = RDF_QUEUE_VISIBILITY_TIMEOUT
+        return self._reliable_pop(keys=self.keys, args=[time.time() + visibility_timeout, consumer],
+                                  client=self._client(pipe))
+
+    def ack(self, value, pipe=None):
+        """
+        Mark an in-flight value as handled
+        """
+        return self._ack(keys=self.keys, args=[value], client=self._client(pipe))
+
+    def nack(self, value, pipe=None):
+        """
+        Put an in-flight value back at the front of the queue
+        """
+        return self._nack(keys=self.keys, args=[value], client=self._client(pipe))
+
+    def extend(self, value, visibility_timeout=None):
+        """
+        Push back the deadline of an in-flight value
+        """
+        if visibility_timeout is None:
+            visibility_timeout = RDF_QUEUE_VISIBILITY_TIMEOUT
+        return self.r.zadd(self.in_flight_name, {value: time.time() + visibility_timeout}, xx=True, ch=True) == 1
 
-    def delete(self):
-        return self.r.delete(self.queue_name)
+    def requeue_expired(self):
+        """
+        Requeue in-flight values whose deadline passed, returns the requeued values
+        """
+        return self._reap(keys=self.keys, args=[time.time()])
+
+    def get_in_flight(self):
+        """
+        Get a dict of in-flight values and the consumers holding them
+        """
+        return self.r.hgetall(self.consumers_name)
+
+    def delete(self, pipe=None):
+        return self._client(pipe).delete(*self.keys)
 
     def get(self, index):
         return self.r.lindex(self.queue_name, index)
 
     def set(self, index, value):
-        return self.r.lset(self.queue_name, index, value)
+        return self._set(keys=self.keys, args=[index, value])
 
     def search(self, value):
         if type(value).__name__ != "str":
             value = str(value)
+        if value not in self:
+            return -1
         elements = self.r.lrange(self.queue_name, 0, -1)
         try:
-            return elements.index(bytes(value, "utf-8"))
+            return elements.index(value)
         except ValueError as e:
             return -1
 
+    def rebuild_index(self):
+        """
+        Rebuild the member set from the list
+        """
+        return self._rebuild_index(keys=self.keys)
+
+
+class PriorityRavQueue(object):
+    """
+    Consume several RavQueues as one, always draining earlier queues first
+
+    e.g. PriorityRavQueue([QUEUE_HIGH_PRIORITY, QUEUE_LOW_PRIORITY])
+    """
+
+    def __init__(self, queues):
+        self.queues = [queue if isinstance(queue, RavQueue) else RavQueue(queue) for queue in queues]
+        self.r = RedisManager.Instance().connect()
+        self.keys = [key for queue in self.queues for key in (queue.queue_name, queue.members_name, queue.notify_name)]
+        self.notify_names = [queue.notify_name for queue in self.queues]
+
+        self._pop = self.r.register_script(POP_FIRST_SCRIPT)
+        self._pop_many = self.r.register_script(POP_MANY_SCRIPT)
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def pop(self, timeout=None, pipe=None):
+        """
+        Pop the first value of the highest priority non-empty queue
+
+        With a timeout, wait up to that many seconds (0 waits forever) for a value to arrive.
+        Blocking pops can't join a pipeline.
+        """
+        if pipe is not None:
+            return self._pop(keys=self.keys, client=pipe)
+
+        value = self._pop(keys=self.keys)
+        if value is not None or timeout is None:
+            return value
+
+        # Block on the notify lists only, the value itself is always taken by the pop script so
+        # the list and the member set change together
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            wait = 0 if deadline is None else int(math.ceil(deadline - time.time()))
+            if deadline is not None and wait <= 0:
+                return None
+            if self.r.blpop(self.notify_names, timeout=wait) is None:
+                return None
+
+            value = self._pop(keys=self.keys)
+            if value is not None:
+                return value
+
+    def pop_many(self, count):
+        """
+        Pop up to count values in priority order in one round trip
+        """
+        if count <= 0:
+            return []
+        return self._pop_many(keys=self.keys, args=[count])
+
+    async def iterate(self, timeout=1):
+        """
+        Async iterator over popped values, blocking pops run in the default executor
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            value = await loop.run_in_executor(None, self.pop, timeout)
+            if value is not None:
+                yield value
+
+    def __aiter__(self):
+        return self.iterate()
+
+
+class QueueReaper(threading.Thread):
+    """
+    Background thread which periodically requeues expired in-flight values of some queues
+    """
+
+    def __init__(self, queue_names, interval=None):
+        super(QueueReaper, self).__init__(daemon=True)
+        self.queues = [RavQueue(name) for name in queue_names]
+        self.interval = interval if interval is not None else RDF_QUEUE_REAPER_INTERVAL
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            for queue in self.queues:
+                queue.requeue_expired()
+
+    def stop(self):
+        self._stopped.set()
+
 
 def clear_redis_queues():
     r = RavQueue(QUEUE_HIGH_PRIORITY)
@@ -60,3 +470,5 @@ def clear_redis_queues():
     r1.delete()
     r2 = RavQueue(QUEUE_COMPUTING)
     r2.delete()
+    # Ready ops of the critical path scheduler and their priorities
+    RedisManager.Instance().connect().delete(QUEUE_READY, "{}:priorities".format(QUEUE_READY))
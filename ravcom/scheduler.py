@@ -0,0 +1,181 @@
+import calendar
+from collections import defaultdict
+
+from . import config
+from .config import QUEUE_READY
+from .redis_manager import RedisManager
+
+
+def critical_path_lengths(parents, costs=None):
+    """
+    Get the length of the longest chain of ops from each op to the end of its graph
+
+    parents maps op ids to their parent op ids, costs optionally maps op ids to an expected run
+    time (1 by default). An op's length includes its own cost. Parents outside of parents' keys are
+    ignored, and ops on a cycle, which can never run, get just their own cost.
+    """
+    costs = costs or {}
+    children = defaultdict(list)
+    remaining = {}
+    for op_id, parent_ids in parents.items():
+        remaining.setdefault(op_id, 0)
+        for parent_id in parent_ids:
+            if parent_id in parents:
+                children[parent_id].append(op_id)
+                remaining[parent_id] = remaining.get(parent_id, 0) + 1
+
+    # Walk up from the sinks, an op is done once all its children are
+    lengths = {}
+    stack = [op_id for op_id, count in remaining.items() if count == 0]
+    while stack:
+        op_id = stack.pop()
+        lengths[op_id] = costs.get(op_id, 1) + max([lengths[child_id] for child_id in children[op_id]] or [0])
+        for parent_id in parents[op_id]:
+            if parent_id in parents:
+                remaining[parent_id] -= 1
+                if remaining[parent_id] == 0:
+                    stack.append(parent_id)
+
+    for op_id in parents:
+        lengths.setdefault(op_id, costs.get(op_id, 1))
+    return lengths
+
+
+def compute_op_priorities(parents, created_at=None, costs=None):
+    """
+    Get the scheduling priority of every op of a graph, higher runs first
+
+    The priority adds up the op's critical path length, its fan-out and the age of its graph,
+    weighted by RDF_SCHEDULER_*_WEIGHT. The age term uses the graph's creation time rather than
+    the time of the call, so priorities of ops queued at different times stay comparable.
+    """
+    lengths = critical_path_lengths(parents, costs=costs)
+
+    fan_out = defaultdict(int)
+    for op_id, parent_ids in parents.items():
+        for parent_id in set(parent_ids):
+            fan_out[parent_id] += 1
+
+    age = -calendar.timegm(created_at.utctimetuple()) if created_at is not None else 0
+    return {op_id: config.RDF_SCHEDULER_CRITICAL_PATH_WEIGHT * lengths[op_id] +
+            config.RDF_SCHEDULER_FAN_OUT_WEIGHT * fan_out[op_id] +
+            config.RDF_SCHEDULER_AGE_WEIGHT * age
+            for op_id in parents}
+
+
+class CriticalPathScheduler(object):
+    """
+    Ready ops in a redis sorted set, popped highest priority first
+
+    schedule_graph() computes the priority of every op of a graph and queues the ready ones.
+    update() is called when an op changes status and queues the children that became ready, so
+    long dependency chains are started before short ones and wide graphs finish sooner.
+    Priorities are kept in a redis hash next to the set so any process can pop and re-queue ops;
+    the readiness of scheduled graphs is tracked in memory by the process that scheduled them.
+    """
+
+    def __init__(self, name=QUEUE_READY):
+        self.name = name
+        self.priorities_name = "{}:priorities".format(name)
+        self.r = RedisManager.Instance().connect()
+
+        self.graphs = {}
+        self._op_graphs = {}
+
+    def schedule_graph(self, db, graph_id, costs=None):
+        """
+        Compute the priorities of a graph's ops and queue the ready ones, returns the number queued
+        """
+        readiness = db.get_graph_readiness(graph_id)
+        graph = db.get_graph(graph_id)
+        graph_ops = {op_id: [parent_id for parent_id in parent_ids if parent_id in readiness.parents]
+                     for op_id, parent_ids in readiness.parents.items()}
+        priorities = compute_op_priorities(graph_ops, created_at=graph.created_at, costs=costs)
+
+        self.graphs[graph_id] = readiness
+        self._op_graphs.update((op_id, graph_id) for op_id in readiness.parents)
+
+        pipe = self.r.pipeline()
+        if priorities:
+            pipe.hset(self.priorities_name, mapping=priorities)
+        if readiness.ready:
+            pipe.zadd(self.name, {op_id: priorities[op_id] for op_id in readiness.ready})
+        pipe.execute()
+        return len(readiness.ready)
+
+    def update(self, op_id, status):
+        """
+        Record an op's new status and queue the ops which became ready, returns them
+        """
+        graph_id = self._op_graphs.get(op_id)
+        if graph_id is None:
+            return set()
+
+        readiness = self.graphs[graph_id]
+        newly_ready = readiness.update(op_id, status)
+        if newly_ready:
+            self.push(newly_ready)
+
+        if not readiness.ready and not readiness.blocked:
+            self.unschedule_graph(graph_id)
+        return newly_ready
+
+    def unschedule_graph(self, graph_id):
+        """
+        Stop tracking a graph and drop its queued ops and priorities
+        """
+        readiness = self.graphs.pop(graph_id, None)
+        if readiness is None:
+            return
+        op_ids = list(readiness.parents)
+        for op_id in op_ids:
+            self._op_graphs.pop(op_id, None)
+        if op_ids:
+            pipe = self.r.pipeline()
+            pipe.zrem(self.name, *op_ids)
+            pipe.hdel(self.priorities_name, *op_ids)
+            pipe.execute()
+
+    def push(self, op_ids):
+        """
+        Queue ops with their stored priority, 0 for ops without one
+        """
+        op_ids = list(op_ids)
+        if not op_ids:
+            return 0
+        priorities = self.r.hmget(self.priorities_name, op_ids)
+        return self.r.zadd(self.name, {op_id: float(priority or 0) for op_id, priority in zip(op_ids, priorities)})
+
+    def pop(self, count=1):
+        """
+        Pop up to count ops, highest priority first, returns a list of (op id, priority)
+        """
+        return [(int(op_id), score) for op_id, score in self.r.zpopmax(self.name, count)]
+
+    def pop_blocking(self, timeout=0):
+        """
+        Pop the highest priority op, waiting up to timeout seconds (0 waits forever), None on timeout
+        """
+        value = self.r.bzpopmax(self.name, timeout=timeout)
+        if value is None:
+            return None
+        _, op_id, score = value
+        return int(op_id), float(score)
+
+    def remove(self, op_id):
+        return self.r.zrem(self.name, op_id)
+
+    def get_priority(self, op_id):
+        priority = self.r.hget(self.priorities_name, op_id)
+        return float(priority) if priority is not None else None
+
+    def __contains__(self, op_id):
+        return self.r.zscore(self.name, op_id) is not None
+
+    def __len__(self):
+        return self.r.zcard(self.name)
+
+    def delete(self):
+        self.r.delete(self.name, self.priorities_name)
+        self.graphs = {}
+        self._op_graphs = {}
@@ -1,5 +1,7 @@
 import socketio
 
+from .codec import decode_frame, is_frame
+
 
 class RavOPNamespace(socketio.ClientNamespace):
     def on_connect(self):
@@ -15,6 +17,9 @@ class RavOPNamespace(socketio.ClientNamespace):
         pass
 
     def on_result(self, data):
+        # Binary results are payload frames, see ravcom.codec
+        if is_frame(data):
+            data = decode_frame(data)
         print(data)
 
 
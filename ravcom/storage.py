@@ -0,0 +1,288 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+from urllib.parse import urlparse
+
+from . import config
+
+# Size of the blocks uploads and downloads are streamed in
+STREAM_BLOCK_SIZE = 1 << 20
+
+
+class StorageBackend(object):
+    """
+    Where data files live
+
+    Files are addressed by location, the string stored in Data.file_path: a plain path for the
+    local backend, a redis:/// or s3:// URI for the others.
+    """
+
+    def location(self, name):
+        """
+        Get the location of a file name under this backend's base
+        """
+        raise NotImplementedError
+
+    def put(self, location, fileobj, ttl=None):
+        """
+        Stream a readable binary file object to a location
+        """
+        raise NotImplementedError
+
+    def open(self, location):
+        """
+        Open a location as a readable binary stream
+        """
+        raise NotImplementedError
+
+    def delete(self, location):
+        """
+        Delete a location, returns False if it didn't exist
+        """
+        raise NotImplementedError
+
+    def exists(self, location):
+        raise NotImplementedError
+
+    def local_path(self, location):
+        """
+        Get the filesystem path of a location, None for remote backends
+        """
+        return None
+
+    def write(self, location, writer, ttl=None):
+        """
+        Call writer with a binary file object and store what it wrote at location
+        """
+        with tempfile.TemporaryFile() as f:
+            writer(f)
+            f.seek(0)
+            self.put(location, f, ttl=ttl)
+        return location
+
+    def put_file(self, location, file_path):
+        """
+        Move a local file to a location
+        """
+        with open(file_path, "rb") as f:
+            self.put(location, f)
+        os.remove(file_path)
+        return location
+
+    def get(self, location):
+        with self.open(location) as f:
+            return f.read()
+
+
+class LocalStorage(StorageBackend):
+    """
+    Files in a local directory, written to a temporary path first so readers never see partial files
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def location(self, name):
+        return os.path.join(self.root, name)
+
+    def local_path(self, location):
+        return urlparse(location).path if location.startswith("file://") else location
+
+    def write(self, location, writer, ttl=None):
+        file_path = self.local_path(location)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        tmp_path = "{}.tmp".format(file_path)
+        with open(tmp_path, "wb") as f:
+            writer(f)
+        os.replace(tmp_path, file_path)
+        return location
+
+    def put(self, location, fileobj, ttl=None):
+        return self.write(location, lambda f: shutil.copyfileobj(fileobj, f, STREAM_BLOCK_SIZE))
+
+    def put_file(self, location, file_path):
+        os.makedirs(os.path.dirname(self.local_path(location)), exist_ok=True)
+        os.replace(file_path, self.local_path(location))
+        return location
+
+    def open(self, location):
+        return open(self.local_path(location), "rb")
+
+    def delete(self, location):
+        try:
+            os.remove(self.local_path(location))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, location):
+        return os.path.exists(self.local_path(location))
+
+
+class RedisBlobReader(io.RawIOBase):
+    """
+    Reads a redis string in blocks with GETRANGE
+    """
+
+    def __init__(self, r, key):
+        self.r = r
+        self.key = key
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), STREAM_BLOCK_SIZE)
+        block = self.r.getrange(self.key, self.position, self.position + size - 1)
+        buffer[:len(block)] = block
+        self.position += len(block)
+        return len(block)
+
+
+class RedisStorage(StorageBackend):
+    """
+    Files as redis strings, for small payloads which need low latency fetches
+
+    Uploads are appended block by block to a temporary key which is renamed when complete.
+    Locations look like redis:///data_1.npy
+    """
+
+    def __init__(self, prefix="blob:"):
+        from .redis_manager import RedisManager
+        self.r = RedisManager.Instance().connect_binary()
+        self.prefix = prefix
+
+    def location(self, name):
+        return "redis:///{}".format(name)
+
+    def _key(self, location):
+        return self.prefix + urlparse(location).path.lstrip("/")
+
+    def put(self, location, fileobj, ttl=None):
+        key = self._key(location)
+        tmp_key = "{}:tmp:{}".format(key, threading.get_ident())
+
+        self.r.set(tmp_key, b"")
+        while True:
+            block = fileobj.read(STREAM_BLOCK_SIZE)
+            if not block:
+                break
+            self.r.append(tmp_key, block)
+
+        pipe = self.r.pipeline()
+        pipe.rename(tmp_key, key)
+        if ttl:
+            pipe.expire(key, int(ttl))
+        pipe.execute()
+        return location
+
+    def open(self, location):
+        key = self._key(location)
+        if not self.r.exists(key):
+            raise FileNotFoundError(location)
+        return io.BufferedReader(RedisBlobReader(self.r, key), buffer_size=STREAM_BLOCK_SIZE)
+
+    def get(self, location):
+        value = self.r.get(self._key(location))
+        if value is None:
+            raise FileNotFoundError(location)
+        return value
+
+    def delete(self, location):
+        return self.r.delete(self._key(location)) == 1
+
+    def exists(self, location):
+        return self.r.exists(self._key(location)) == 1
+
+
+class S3Storage(StorageBackend):
+    """
+    Files in an S3 compatible object store, e.g. a local minio for testing via RDF_S3_ENDPOINT_URL
+
+    Locations look like s3://bucket/prefix/data_1.npy, boto3 must be installed.
+    """
+
+    def __init__(self, bucket, prefix=""):
+        try:
+            import boto3
+        except ImportError:
+            raise ImportError("boto3 is required for s3:// storage")
+
+        self.client = boto3.client("s3", endpoint_url=config.RDF_S3_ENDPOINT_URL)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def location(self, name):
+        key = "{}/{}".format(self.prefix, name) if self.prefix else name
+        return "s3://{}/{}".format(self.bucket, key)
+
+    def _key(self, location):
+        return urlparse(location).path.lstrip("/")
+
+    def put(self, location, fileobj, ttl=None):
+        self.client.upload_fileobj(fileobj, self.bucket, self._key(location))
+        return location
+
+    def open(self, location):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(location))["Body"]
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(location)
+
+    def delete(self, location):
+        exists = self.exists(location)
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(location))
+        return exists
+
+    def exists(self, location):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(location))
+            return True
+        except ClientError:
+            return False
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_storage(location=None):
+    """
+    Get the backend a location belongs to, or the default one from RDF_STORAGE_URI
+    """
+    if location is None:
+        location = config.RDF_STORAGE_URI
+
+    parsed = urlparse(location)
+    if parsed.scheme == "redis":
+        name = ("redis", "")
+    elif parsed.scheme == "s3":
+        name = ("s3", parsed.netloc)
+    else:
+        name = ("file", "")
+
+    with _backends_lock:
+        if name not in _backends:
+            if name[0] == "redis":
+                _backends[name] = RedisStorage()
+            elif name[0] == "s3":
+                default = urlparse(config.RDF_STORAGE_URI)
+                prefix = default.path if default.scheme == "s3" and default.netloc == parsed.netloc else ""
+                _backends[name] = S3Storage(parsed.netloc, prefix=prefix)
+            else:
+                default = urlparse(config.RDF_STORAGE_URI)
+                root = default.path if default.scheme in ("", "file") else config.DATA_FILES_PATH
+                _backends[name] = LocalStorage(root)
+        return _backends[name]
+
+
+def get_location(name):
+    """
+    Get the location of a file name in the default backend
+    """
+    return get_storage().location(name)
@@ -0,0 +1,209 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+from .chunked_store import CHUNKED_EXTENSION, load_chunked
+from .config import RDF_TENSOR_COMPRESSION
+from .storage import get_location, get_storage
+
+NPY_EXTENSION = ".npy"
+ZLIB_EXTENSION = ".npy.z"
+LEGACY_EXTENSION = ".json"
+
+# Size of the blocks streamed through zlib when compressing a tensor
+COMPRESS_BLOCK_SIZE = 1 << 20
+
+
+def get_tensor_path(data_id, compress=False, storage=None):
+    """
+    Get the location of the file a tensor is stored in, in the default storage unless one is given
+    """
+    extension = ZLIB_EXTENSION if compress else NPY_EXTENSION
+    name = "data_{}{}".format(data_id, extension)
+    return storage.location(name) if storage is not None else get_location(name)
+
+
+def get_tensor_paths(data_id):
+    """
+    Get every location a tensor could have been stored in, including legacy json files
+    """
+    return [get_location("data_{}{}".format(data_id, extension))
+            for extension in (NPY_EXTENSION, ZLIB_EXTENSION, CHUNKED_EXTENSION, LEGACY_EXTENSION)]
+
+
+def to_ndarray(data):
+    """
+    Convert data to a contiguous ndarray that can be written without pickling
+    """
+    array = np.asarray(data)
+    if not array.flags.c_contiguous:
+        array = np.ascontiguousarray(array)
+    if array.dtype.hasobject:
+        raise TypeError("Unable to store data of type {} as a tensor".format(type(data).__name__))
+    return array
+
+
+def hash_tensor(data):
+    """
+    Sha256 hex digest of a tensor's dtype, shape and contents
+    """
+    array = to_ndarray(data)
+    digest = hashlib.sha256("{}{}".format(array.dtype.str, array.shape).encode("utf-8"))
+    digest.update(array.reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+def save_tensor(data_id, data, compress=None, storage=None, ttl=None):
+    """
+    Write data to a .npy file, i.e. a npy header followed by the contiguous buffer
+
+    With compression enabled the same bytes are streamed through zlib. The file is written
+    through the storage backend, which never exposes a partially written tensor. ttl is passed to
+    backends which expire files, i.e. redis. Returns the file location and the ndarray which was written.
+    Data which isn't a tensor, e.g. a dict or a ragged list, is written with save_json() instead
+    and returned as is.
+    """
+    if compress is None:
+        compress = RDF_TENSOR_COMPRESSION == "zlib"
+
+    try:
+        array = to_ndarray(data)
+    except (TypeError, ValueError):
+        return save_json(data_id, data, storage=storage, ttl=ttl), data
+    file_path = get_tensor_path(data_id, compress=compress, storage=storage)
+
+    def write(f):
+        if compress:
+            _write_compressed(f, array)
+        else:
+            np.lib.format.write_array(f, array, allow_pickle=False)
+
+    get_storage(file_path).write(file_path, write, ttl=ttl)
+    return file_path, array
+
+
+def save_json(data_id, data, storage=None, ttl=None):
+    """
+    Write data to a legacy .json file, for payloads which aren't tensors
+    """
+    name = "data_{}{}".format(data_id, LEGACY_EXTENSION)
+    file_path = storage.location(name) if storage is not None else get_location(name)
+    value = json.dumps(data.tolist() if isinstance(data, np.ndarray) else data).encode("utf-8")
+    get_storage(file_path).write(file_path, lambda f: f.write(value), ttl=ttl)
+    return file_path
+
+
+def encode_inline(data, max_length):
+    """
+    Encode a small tensor's values as json to store in a column, None if it doesn't fit
+
+    The dtype and shape are stored separately and passed back to decode_inline().
+    """
+    array = to_ndarray(data)
+    try:
+        value = json.dumps(array.tolist())
+    except (TypeError, ValueError):
+        return None
+    return value if len(value) <= max_length else None
+
+
+def decode_inline(value, dtype, shape):
+    """
+    Decode a tensor encoded with encode_inline()
+    """
+    return np.asarray(json.loads(value), dtype=np.dtype(dtype)).reshape(shape)
+
+
+def _write_compressed(f, array):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_2_0(header, np.lib.format.header_data_from_array_1_0(array))
+
+    compressor = zlib.compressobj()
+    f.write(compressor.compress(header.getvalue()))
+
+    buffer = array.reshape(-1).view(np.uint8)
+    for start in range(0, buffer.size, COMPRESS_BLOCK_SIZE):
+        f.write(compressor.compress(buffer[start:start + COMPRESS_BLOCK_SIZE]))
+    f.write(compressor.flush())
+
+
+def load_tensor(file_path, mmap_mode="r"):
+    """
+    Load a tensor from the store
+
+    Uncompressed tensors are memory-mapped (pass mmap_mode=None to read them into memory), so
+    slicing a large operand only touches the pages it needs. Chunked tensors are returned as a
+    ChunkedTensor, compressed tensors are always read fully and legacy json files are converted
+    to ndarrays, unless they hold a dict or ragged list. Tensors in a remote backend are streamed
+    into memory, chunked ones are downloaded to a temporary file first.
+    """
+    storage = get_storage(file_path)
+    local_path = storage.local_path(file_path)
+    if local_path is None:
+        return _load_remote(storage, file_path)
+    file_path = local_path
+
+    if file_path.endswith(CHUNKED_EXTENSION):
+        return load_chunked(file_path)
+    elif file_path.endswith(ZLIB_EXTENSION):
+        with open(file_path, "rb") as f:
+            raw = zlib.decompress(f.read())
+        return np.lib.format.read_array(io.BytesIO(raw), allow_pickle=False)
+    elif file_path.endswith(LEGACY_EXTENSION):
+        with open(file_path, "r") as f:
+            return _from_json(json.load(f))
+
+    try:
+        return np.load(file_path, mmap_mode=mmap_mode, allow_pickle=False)
+    except ValueError:
+        # Empty arrays can't be memory-mapped
+        return np.load(file_path, allow_pickle=False)
+
+
+def _from_json(value):
+    # Dicts and ragged lists are returned as they were stored
+    try:
+        array = np.asarray(value)
+    except ValueError:
+        return value
+    return value if array.dtype.hasobject else array
+
+
+def _load_remote(storage, file_path):
+    if file_path.endswith(CHUNKED_EXTENSION):
+        with storage.open(file_path) as f, tempfile.NamedTemporaryFile(suffix=CHUNKED_EXTENSION,
+                                                                        delete=False) as tmp:
+            shutil.copyfileobj(f, tmp)
+        tensor = load_chunked(tmp.name)
+        # The memory map keeps the downloaded copy alive until the tensor is closed
+        os.remove(tmp.name)
+        return tensor
+    elif file_path.endswith(ZLIB_EXTENSION):
+        raw = zlib.decompress(storage.get(file_path))
+        return np.lib.format.read_array(io.BytesIO(raw), allow_pickle=False)
+    elif file_path.endswith(LEGACY_EXTENSION):
+        return _from_json(json.loads(storage.get(file_path).decode("utf-8")))
+
+    with storage.open(file_path) as f:
+        return np.lib.format.read_array(f, allow_pickle=False)
+
+
+def tensor_exists(file_path):
+    """
+    Check whether a stored tensor still exists in its backend
+    """
+    return file_path is not None and get_storage(file_path).exists(file_path)
+
+
+def delete_tensor(file_path):
+    """
+    Delete a stored tensor if it exists
+    """
+    if file_path is not None:
+        get_storage(file_path).delete(file_path)
@@ -1,50 +1,49 @@
-import json
-import os
+import pickle
 import shutil
-
-import numpy as np
+import threading
 
 from ravcom.socket_client import SocketClient
-from .config import DATA_FILES_PATH, RAVSOCK_SERVER_URL
+from .config import RAVSOCK_SERVER_URL
+from .storage import get_location, get_storage
+from .tensor_store import save_tensor, load_tensor
 
 
-def save_data_to_file(data_id, data):
+def save_data_to_file(data_id, data, compress=None):
     """
-    Method to save data in a pickle file
+    Method to save data in the binary tensor store
     """
-    file_path = os.path.join(DATA_FILES_PATH, "data_{}.json".format(data_id))
-
-    if os.path.exists(file_path):
-        os.remove(file_path)
-
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, "w") as f:
-        if isinstance(data, np.ndarray):
-            data = data.tolist()
-        json.dump(data, f)
-
+    file_path, _ = save_tensor(data_id, data, compress=compress)
     return file_path
 
 
-def load_data_from_file():
-    pass
+def load_data_from_file(file_path, mmap=True):
+    """
+    Method to load data saved by save_data_to_file, memory-mapped where possible
+    """
+    return load_tensor(file_path, mmap_mode="r" if mmap else None)
 
 
 def delete_data_file(data_id):
-    file_path = os.path.join(DATA_FILES_PATH, "data_{}.json".format(data_id))
-    if os.path.exists(file_path):
-        os.remove(file_path)
+    """
+    Delete the files of a data id, files other data rows still point to are kept
+    """
+    # Imported here as db_manager imports this module
+    from .db_manager import DBManager
+    DBManager.Instance().delete_data_file(data_id)
 
 
 class Singleton:
     def __init__(self, cls):
         self._cls = cls
+        self._lock = threading.Lock()
 
     def Instance(self):
         try:
             return self._instance
         except AttributeError:
-            self._instance = self._cls()
+            with self._lock:
+                if not hasattr(self, "_instance"):
+                    self._instance = self._cls()
             return self._instance
 
     def __call__(self):
@@ -58,17 +57,21 @@ def dump_data(data_id, value):
     """
     Dump ndarray to file
     """
-    file_path = os.path.join(DATA_FILES_PATH, "data_{}.pkl".format(data_id))
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    value.dump(file_path)
+    file_path = get_location("data_{}.pkl".format(data_id))
+    get_storage(file_path).write(file_path, lambda f: pickle.dump(value, f, protocol=2))
     return file_path
 
 
 def copy_data(source, destination):
     try:
-        shutil.copy(source, destination)
+        if source == destination:
+            raise shutil.SameFileError(source)
+        source_storage, destination_storage = get_storage(source), get_storage(destination)
+        if source_storage.local_path(source) is not None and destination_storage.local_path(destination) is not None:
+            shutil.copy(source_storage.local_path(source), destination_storage.local_path(destination))
+        else:
+            with source_storage.open(source) as f:
+                destination_storage.put(destination, f)
         print("File copied successfully.")
     # If source and destination are same
     except shutil.SameFileError:
@@ -0,0 +1,66 @@
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class WriteBehindWriter(object):
+    """
+    Bounded thread pool which runs writes in the background
+
+    submit() blocks once max_pending writes are queued or running, so producers can't get further
+    ahead of the storage than that. Writes are keyed, e.g. by data id, so readers can wait for one.
+    """
+
+    def __init__(self, max_workers=4, max_pending=64):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ravdb-writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Run fn in the background, blocking while the writer is full
+        """
+        self._slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._pending[key] = future
+        future.add_done_callback(functools.partial(self._done, key))
+        return future
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+        self._slots.release()
+
+    def wait(self, key, timeout=None):
+        """
+        Wait for the write of a key if one is pending, returns False on timeout
+        """
+        with self._lock:
+            future = self._pending.get(key)
+        if future is None:
+            return True
+        return not wait([future], timeout=timeout).not_done
+
+    def flush(self, timeout=None):
+        """
+        Wait for every pending write, returns the number of them which failed
+        """
+        with self._lock:
+            futures = list(self._pending.values())
+        done, _ = wait(futures, timeout=timeout)
+        return sum(1 for future in done if future.exception() is not None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)